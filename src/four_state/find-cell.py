@@ -28,6 +28,8 @@ import csv
 import multiprocessing
 import yaml
 
+from superhex.superhex import half_neighbor_list
+
 def process_structure(struct_entry, supercells_dir, magnetic_atoms, dis_cut, dis_tol,num_neigh):
     """Process a single structure file and extract valid neighbors"""
 
@@ -51,8 +53,8 @@ def process_structure(struct_entry, supercells_dir, magnetic_atoms, dis_cut, dis
     non_magnetic_atoms = [element.symbol for element in structure.composition.elements if not element.is_magnetic]
     structure.remove_species(non_magnetic_atoms)
 
-    # Get neighbor list
-    center_indices, point_indices, offset_vectors, distances = structure.get_neighbor_list(dis_cut)
+    # Get neighbor list, each pair once
+    center_indices, point_indices, offset_vectors, distances = half_neighbor_list(*structure.get_neighbor_list(dis_cut))
 
     precision=int(-np.log10(dis_tol))
     unique_distances, counts = np.unique(np.around(distances, precision), return_counts=True)
@@ -63,7 +65,7 @@ def process_structure(struct_entry, supercells_dir, magnetic_atoms, dis_cut, dis
     for distance in unique_distances[:num_neigh]:
         for atom1, atom2, d, offset_vec in zip(center_indices, point_indices, distances, offset_vectors):
             if np.isclose(distance, d, atol=dis_tol):
-                key = tuple(sorted([atom1, atom2]))  # Ensure symmetry
+                key = (atom1, atom2)  # atom1 <= atom2 in the half list
                 pair_dict[key]["offsets"].append(tuple(offset_vec))
                 pair_dict[key]["distances"].append(d)
 
@@ -204,6 +206,12 @@ def main():
         reader = csv.DictReader(csvfile)
         struct_data = [row for row in reader]
 
+    # superhex may only have written some of the supercells (write_supercells)
+    missing = [row for row in struct_data if not os.path.exists(os.path.join(params["supercells_dir"], f"cell-vol{row['struct_vol']}-num{row['struct_num']}.vasp"))]
+    if missing:
+        print(f"{len(missing)} supercells of {params['struct_analysis']} have no structure file and are skipped")
+        struct_data = [row for row in struct_data if row not in missing]
+
     # Sort by volume + num
     struct_data.sort(key=lambda x: (int(x["struct_vol"]), int(x["struct_num"])))
     # Parallel
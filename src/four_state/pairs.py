@@ -25,6 +25,8 @@ import argparse
 from collections import Counter
 import sys
 
+from superhex.superhex import half_neighbor_list
+
 # ------------------------------
 # Helper: Parse logical variable
 # ------------------------------
@@ -255,8 +257,9 @@ magnetic_elements = [el.symbol for el in structure.composition.elements if el.na
 structure_magnetic = structure.copy()
 structure_magnetic.remove_species([el for el in structure_magnetic.symbol_set if el not in magnetic_elements])
 
-# Get neighbor list
-center_indices, point_indices, offset_vectors, distances = structure_magnetic.get_neighbor_list(dis_cut)
+# Get neighbor list (each pair and image once; the reverse bond (j, i, -R)
+# is accounted for explicitly below)
+center_indices, point_indices, offset_vectors, distances = half_neighbor_list(*structure_magnetic.get_neighbor_list(dis_cut))
 unique_distances, counts = np.unique(np.around(distances, precision), return_counts=True)
 
 
@@ -275,10 +278,7 @@ pair_dict = defaultdict(lambda: {"offsets": [], "distances": []})
 for distance in unique_distances[:num_neigh]:
     for atom1, atom2, d, offset_vec in zip(center_indices, point_indices, distances, offset_vectors):
         if np.isclose(distance, d, atol=dis_tol):
-           if check_env_fp:
-              key = tuple(([atom1, atom2]))  # Ensure symmetry
-           else:
-              key = tuple(sorted([atom1, atom2]))  # Ensure symmetry
+           key = (atom1, atom2)  # atom1 <= atom2 in the half list
            pair_dict[key]["offsets"].append(tuple(offset_vec))
            pair_dict[key]["distances"].append(d)
 
@@ -328,10 +328,13 @@ for i, distance in enumerate(unique_distances[:num_neigh]):
         
                 fp = get_bond_environment_fingerprint(A_cart, B_cart, structure, dis_cut)
 
-                # Track fingerprint and offset separately
+                # Track fingerprint and offset separately; the reverse bond
+                # (atom2, atom1, -offset) has the same midpoint environment
                 offset_key = tuple(offset_vec)
                 fp_counter[(atom1, atom2)][fp]["offsets"].append(offset_key)
                 fp_counter[(atom1, atom2)][fp]["count"] += 1
+                fp_counter[(atom2, atom1)][fp]["offsets"].append(tuple(0.0 - offset_frac))
+                fp_counter[(atom2, atom1)][fp]["count"] += 1
 
         # === Compare same pair with different offsets ===
 
@@ -390,7 +393,7 @@ for i, distance in enumerate(unique_distances[:num_neigh]):
                  ## Reject if this distance also appears in self-pairs
                  #if any(round(distance, precision) in self_distances[atom] for atom in (atom1, atom2)):
                  #   continue  # skip: could be a periodic self-image
-                 multi = len(distances_list) # * 0.5
+                 multi = 2 * len(distances_list)  # both directions of every bond
                  valid_neighbors.append((atom1, atom2, multi))                
 
 
@@ -60,6 +60,42 @@ def is_equiv_lattice(lat1, lat2, eps):
     
     return is_equiv_lattice
 
+def is_equiv_lattice_batch(lat1, lat2, eps):
+    """
+    Vectorized version of is_equiv_lattice: compare every lattice in lat1
+    with every lattice in lat2 in a single array operation.
+
+    Parameters:
+    lat1 : numpy.ndarray
+        Stack of 3x3 lattice matrices, shape (n1, 3, 3), e.g. all the
+        rotated images of one candidate supercell.
+    lat2 : numpy.ndarray
+        Stack of 3x3 lattice matrices, shape (n2, 3, 3), e.g. all the
+        unique supercells found so far.
+    eps : float
+        Tolerance value for checking equivalence.
+
+    Returns:
+    numpy.ndarray
+        Boolean array of shape (n2, n1); element [j, i] is True if lat1[i]
+        and lat2[j] are equivalent (same criterion as is_equiv_lattice).
+    """
+    atol = 5e-4
+
+    # One batched inversion for the whole stack instead of one per pair
+    lat1inv = np.linalg.inv(lat1)
+
+    # S[j, i] = lat1[i]^-1 @ lat2[j]
+    S = np.einsum('iab,jbc->jiac', lat1inv, lat2)
+    det_S = np.linalg.det(S)
+
+    # Same test as np.allclose(a, b, atol=atol, rtol=eps), elementwise
+    det_ok = np.abs(np.abs(det_S) - 1.0) <= atol + eps
+    S_round = np.round(S)
+    int_ok = (np.abs(S - S_round) <= atol + eps * np.abs(S_round)).all(axis=(2, 3))
+
+    return det_ok & int_ok
+
 # Example usage:
 #lat1 = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
 #lat2 = np.array([[0.0, 1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
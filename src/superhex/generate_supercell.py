@@ -22,15 +22,20 @@ import numpy as np
 import os
 import sys
 import copy
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 from pymatgen.core.structure import Structure
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer 
 from pymatgen.transformations.advanced_transformations import  SupercellTransformation
 
+from pymatgen.optimization.neighbors import find_points_in_spheres
+
 from ase.geometry import is_minkowski_reduced, minkowski_reduce
 
-from superhex.hnf_lib import get_all_2D_HNFs, get_all_HNFs
-from superhex.compare_structures import is_equiv_lattice  
+from superhex.hnf_lib import get_all_2D_HNFs, get_all_HNFs, iter_2D_HNFs, iter_HNFs, canonical_hnf, count_hnf_fixed_points
+from superhex.compare_structures import is_equiv_lattice_batch
+from superhex.hnf_cache import default_cache_dir, hnf_cache_key, load_unique_hnf, save_unique_hnf, load_minkowski_ops, save_minkowski_ops
 
 
 def rotation_matrix(structure, LatDim):
@@ -52,14 +57,54 @@ def rotation_matrix(structure, LatDim):
     return rot, nRot
 
 
-def generate_structures(structure, volumes, LatDim, write_str=False, verbosity='low'):
-    
+def integer_rotations(rot, parent_lattice):
+    """
+    Express the Cartesian point-group operations in the basis of the parent
+    lattice (columns of parent_lattice.T), where they are integer matrices.
+    """
+    latt = parent_lattice.T
+    int_rot = np.linalg.inv(latt) @ rot @ latt
+    int_rot_round = np.round(int_rot)
+    if not np.allclose(int_rot, int_rot_round, atol=1e-3):
+        raise ValueError("Symmetry operations are not integer in the basis of the parent lattice")
+    # Rotations sharing the same matrix (different fractional translations) are redundant here
+    return np.unique(int_rot_round.astype(np.int64), axis=0)
+
+
+def hnf_chunks(vol, LatDim, chunk_size=4096):
+    if LatDim==2:
+        return iter_2D_HNFs(vol, chunk_size)
+    return iter_HNFs(vol, chunk_size)
+
+
+def _unique_chunk(chunk, dedupe_method, parent_lattice, rot, int_rot, eps):
+    """Pool task: dedupe one chunk of HNF candidates on its own."""
+    if dedupe_method == 'canonical':
+        uq_hnf, iuq = find_unique_matrices_canonical([chunk], int_rot)
+    else:
+        uq_hnf, iuq = find_unique_matrices(chunk.shape[0], len(rot), parent_lattice, chunk, rot, eps)
+    return uq_hnf
+
+
+def generate_structures(structure, volumes, LatDim, write_str=False, verbosity='low', dedupe_method='tolerance', use_cache=False, cache_dir=None, num_processes=1, prune_shells=None, exist_ok=False):
+    """
+    Symmetry-inequivalent supercells of every volume, as a dict
+    {volume: {supercell number: Supercell}}; the Structures are only built
+    to write their POSCAR files (write_str). With prune_shells (see
+    degenerate_supercells), the supercells in which one of these shells
+    can only couple a site to its own periodic images are not built.
+    An existing supercells directory is an error unless exist_ok is True
+    (resumed runs, or volumes generated one at a time), in which case only
+    the missing POSCAR files are written.
+    """
     rot, nRot=rotation_matrix(structure, LatDim)
     parent_lattice = structure.lattice.matrix
     eps = 1e-6  # Tolerance for equivalence checking
 
     struct_dir = "supercells"
-    if os.path.exists(struct_dir):
+    if os.path.exists(struct_dir) and exist_ok:
+        print(f"Directory '{struct_dir}' already exists, only the missing files are written.")
+    elif os.path.exists(struct_dir):
         print(f"Directory '{struct_dir}' already exists.")
         print(f"Please remove or rename '{struct_dir}' directory")
         sys.exit()  
@@ -69,46 +114,185 @@ def generate_structures(structure, volumes, LatDim, write_str=False, verbosity='
 
 
     all_structures={}
-    
-    for vol in volumes:
-        if LatDim==2:
-            hnf = get_all_2D_HNFs(vol)
+
+    int_rot = None
+    if dedupe_method == 'canonical' or use_cache:
+        int_rot = integer_rotations(rot, parent_lattice)
+
+    if use_cache and cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    uq_hnfs = {}
+    all_ops = {}
+    keys = {}
+    if use_cache:
+        for vol in volumes:
+            keys[vol] = hnf_cache_key(int_rot, LatDim, vol, dedupe_method)
+            uq_hnf = load_unique_hnf(cache_dir, keys[vol])
+            if uq_hnf is not None:
+                uq_hnfs[vol] = uq_hnf
+                all_ops[vol] = load_minkowski_ops(cache_dir, keys[vol], parent_lattice)
+
+    todo = [vol for vol in volumes if vol not in uq_hnfs]
+
+    # Only the dedupe, the Minkowski reduction and the POSCAR writes of
+    # the volumes missing from the cache use the pool
+    need_pool = num_processes > 1 and (todo or any(all_ops.get(vol) is None for vol in volumes) or write_str)
+    pool = Pool(processes=num_processes) if need_pool else None
+    try:
+        if pool is not None:
+            # Every chunk of every volume is deduped on its own on the pool; the
+            # chunk results are then merged in order, keeping the first HNF of
+            # each orbit, so the result is the same as the serial dedupe.
+            tasks = [(vol, chunk) for vol in todo for chunk in hnf_chunks(vol, LatDim, chunk_size=1024)]
+            local_uq = pool.starmap(_unique_chunk, [(chunk, dedupe_method, parent_lattice, rot, int_rot, eps) for vol, chunk in tasks])
+            for vol in todo:
+                merged = [uq for (v, chunk), uq in zip(tasks, local_uq) if v == vol]
+                if dedupe_method == 'canonical':
+                    uq_hnfs[vol], iuq = find_unique_matrices_canonical(merged, int_rot)
+                else:
+                    merged = np.concatenate(merged)
+                    uq_hnfs[vol], iuq = find_unique_matrices(merged.shape[0], nRot, parent_lattice, merged, rot, eps)
         else:
-            hnf = get_all_HNFs(vol)
+            for vol in todo:
+                if dedupe_method == 'canonical':
+                    # HNFs are consumed in bounded-memory chunks; only the unique ones are kept
+                    uq_hnfs[vol], iuq = find_unique_matrices_canonical(hnf_chunks(vol, LatDim), int_rot)
+                else:
+                    if LatDim==2:
+                        hnf = get_all_2D_HNFs(vol)
+                    else:
+                        hnf = get_all_HNFs(vol)
  
-        Nhnf,_,_= hnf.shape
+                    Nhnf,_,_= hnf.shape
+
+                    uq_hnfs[vol], iuq = find_unique_matrices(Nhnf, nRot, parent_lattice, hnf, rot, eps)
 
-        uq_hnf,iuq = find_unique_matrices(Nhnf, nRot, parent_lattice, hnf, rot, eps)
+        todo = [vol for vol in volumes if all_ops.get(vol) is None]
+        if pool is not None:
+            ops_list = pool.starmap(minkowski_ops, [(uq_hnfs[vol], uq_hnfs[vol].shape[0], parent_lattice, LatDim) for vol in todo])
+        else:
+            ops_list = [minkowski_ops(uq_hnfs[vol], uq_hnfs[vol].shape[0], parent_lattice, LatDim) for vol in todo]
+        for vol, ops in zip(todo, ops_list):
+            all_ops[vol] = ops
+            if use_cache:
+                save_unique_hnf(cache_dir, keys[vol], uq_hnfs[vol])
+                save_minkowski_ops(cache_dir, keys[vol], parent_lattice, ops)
+
+        trans = {}
+        keep = {}
+        for vol in volumes:
+            iuq = uq_hnfs[vol].shape[0]
+            trans[vol] = transformation_matrices(uq_hnfs[vol], iuq, all_ops[vol], parent_lattice)
+            if prune_shells is None:
+                keep[vol] = list(range(iuq))
+            else:
+                keep[vol] = list(np.flatnonzero(~degenerate_supercells(trans[vol], parent_lattice, *prune_shells)))
+                print(f"volume {vol}: {iuq - len(keep[vol])} of {iuq} supercells pruned")
+
+        for vol in volumes:
+            all_structures[vol] = {i: Supercell(vol, i, uq_hnfs[vol][i], all_ops[vol][i], trans[vol][i]) for i in keep[vol]}
+
+        if write_str:
+            args = [(structure, trans[vol][i], supercell_filename(struct_dir, vol, i)) for vol in volumes for i in keep[vol]]
+            args = [arg for arg in args if not os.path.exists(arg[2])]
+            if pool is not None:
+                pool.starmap(_write_supercell, args)
+            else:
+                for arg in args:
+                    _write_supercell(*arg)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
-        all_structures[vol]=supercells(structure,struct_dir, uq_hnf, iuq, vol, parent_lattice, LatDim, write_str, verbosity=verbosity)
+    for vol in volumes:
+        write_supercell_log(uq_hnfs[vol], uq_hnfs[vol].shape[0], vol, all_ops[vol], trans[vol], verbosity)
 
     return  all_structures
 
         
 
 
+def count_unique_supercells(vol, int_rot, LatDim):
+    """
+    Number of symmetry-inequivalent supercells of a given volume from
+    Burnside's lemma: the average, over the point group, of the number of
+    HNFs left invariant by each operation. No supercell is constructed.
+    """
+    if LatDim==2:
+        hnf_chunks = iter_2D_HNFs(vol)
+    else:
+        hnf_chunks = iter_HNFs(vol)
+
+    Nhnf = 0
+    fixed = np.zeros(len(int_rot), dtype=np.int64)
+    for chunk in hnf_chunks:
+        Nhnf += chunk.shape[0]
+        fixed += count_hnf_fixed_points(chunk.astype(np.int64), int_rot)
+
+    nuq, rem = divmod(int(fixed.sum()), len(int_rot))
+    if rem != 0:
+        raise ValueError("Burnside count is not an integer; the rotations do not form a group")
+
+    return Nhnf, nuq
+
+
+def estimate_workload(structure, volumes, LatDim, magnetic_atoms, cutoff_radius):
+    """
+    Dry run of generate_structures: predict, for every volume, the number of
+    HNFs, of inequivalent supercells, of magnetic sites and of neighbor pairs
+    within cutoff_radius per supercell (every pair and periodic image once,
+    as in the half neighbor lists of the analysis).
+    Only the parent structure is used.
+    """
+    rot, nRot = rotation_matrix(structure, LatDim)
+    parent_lattice = structure.lattice.matrix
+    int_rot = integer_rotations(rot, parent_lattice)
+
+    mag_coords = np.array([site.coords for site in structure if site.specie.name in magnetic_atoms])
+    nmag = len(mag_coords)
+
+    # A supercell has the same environment around every site as the parent,
+    # so its number of neighbor pairs is vol times that of the parent cell.
+    _, _, _, distances = find_points_in_spheres(mag_coords, mag_coords, r=float(cutoff_radius),
+                                                pbc=np.array(structure.lattice.pbc, dtype=int),
+                                                lattice=np.array(parent_lattice), tol=1e-8)
+    npairs = int(np.sum(distances > 1e-8)) // 2  # both directions are listed
+
+    estimate = {'volume':[], 'n_hnf':[], 'n_supercells':[], 'magnetic_sites':[], 'total_magnetic_sites':[], 'pairs_per_supercell':[]}
+    for vol in volumes:
+        Nhnf, nuq = count_unique_supercells(vol, int_rot, LatDim)
+        estimate['volume'].append(vol)
+        estimate['n_hnf'].append(Nhnf)
+        estimate['n_supercells'].append(nuq)
+        estimate['magnetic_sites'].append(nmag*vol)
+        estimate['total_magnetic_sites'].append(nuq*nmag*vol)
+        estimate['pairs_per_supercell'].append(npairs*vol)
+
+    return estimate
+
+
+
 def find_unique_matrices(Nhnf, nRot, parent_lattice, hnf, rot, eps):
     iuq = 1
     temp_hnf = copy.deepcopy(hnf)
-    
-    for i in range(1, Nhnf):
-        duplicate = False
 
-        for j in range(iuq):
-            for irot in range(nRot):
-                test_latticei = np.matmul(rot[irot,:, :], parent_lattice.T@hnf[i,:,:,])
-                test_latticej = parent_lattice.T@temp_hnf[j,:, :]
+    # Lattices of the unique supercells found so far (filled incrementally)
+    uq_latt = np.zeros((Nhnf, 3, 3))
+    uq_latt[0, :, :] = parent_lattice.T@hnf[0, :, :]
 
+    for i in range(1, Nhnf):
+        # All rotated images of the candidate: rot[irot] @ parent_lattice.T @ hnf[i]
+        test_latticei = np.matmul(rot, parent_lattice.T@hnf[i, :, :])
+
+        # Compare with every unique lattice and every rotation at once
+        duplicate = is_equiv_lattice_batch(test_latticei, uq_latt[:iuq], eps).any()
 
-                if is_equiv_lattice(test_latticei, test_latticej, eps):
-                    duplicate = True
-                    break
-            if duplicate:
-                break
-        
         if not duplicate:
             iuq += 1
             temp_hnf[iuq-1, :, :] = hnf[i,:, :]
+            uq_latt[iuq-1, :, :] = parent_lattice.T@hnf[i, :, :]
     
     uq_hnf = temp_hnf[:iuq,:,:]
    
@@ -116,42 +300,171 @@ def find_unique_matrices(Nhnf, nRot, parent_lattice, hnf, rot, eps):
 
 
 
-def supercells(structure,struct_dir, uq_hnf, iuq, vol, parent_lattice, LatDim, write_str=False, verbosity='low'):
-    new_structure=[]
+def find_unique_matrices_canonical(hnf_chunks, int_rot):
+    """
+    Exact, tolerance-free alternative to find_unique_matrices. Every HNF is
+    mapped to the canonical (lexicographically smallest) HNF of its orbit
+    under the integer rotations, so the dedupe is a set lookup and the
+    cost is linear in the number of HNFs. hnf_chunks is an iterable of
+    (n, 3, 3) arrays (e.g. iter_HNFs); the first HNF of each orbit is kept,
+    as in find_unique_matrices.
+    """
+    seen = set()
+    uq_hnf = []
+
+    for chunk in hnf_chunks:
+        chunk = chunk.astype(np.int64)
+        for i in range(chunk.shape[0]):
+            key = canonical_hnf(chunk[i, :, :], int_rot).tobytes()
+            if key not in seen:
+                seen.add(key)
+                uq_hnf.append(chunk[i, :, :])
+
+    uq_hnf = np.array(uq_hnf)
 
+    return uq_hnf, len(uq_hnf)
+
+
+
+def minkowski_ops(uq_hnf, iuq, parent_lattice, LatDim):
+    """
+    Minkowski reduction matrices (integer, shape (iuq, 3, 3)) of the
+    supercell lattices uq_hnf[i].T @ parent_lattice.
+    """
     if LatDim==2:
         PBC=[True, True, False]
     else:
         PBC=[True, True, True ]
 
-    if verbosity=='high' or verbosity=='medium':
-        logfile=open('log.txt', 'a+')
-
+    ops = np.zeros((iuq, 3, 3), dtype=int)
     for i in range(iuq):
-        
-        rcell,op=minkowski_reduce(uq_hnf[i,:,:].T@parent_lattice, pbc=PBC)
-        
-        if not np.allclose(op@uq_hnf[i,:,:].T@parent_lattice, rcell):
+        rcell,ops[i,:,:]=minkowski_reduce(uq_hnf[i,:,:].T@parent_lattice, pbc=PBC)
+
+        if not np.allclose(ops[i,:,:]@uq_hnf[i,:,:].T@parent_lattice, rcell):
             print("Something wrong with minkowski's reduction")
 
+    return ops
+
+
+
+def transformation_matrices(uq_hnf, iuq, ops, parent_lattice):
+    """
+    Supercell transformation matrices (+/-1 * minkowski_reduce_matrix @ HNF_matrix.T)
+    as used by SupercellTransformation.
+    """
+    trans = np.zeros((iuq, 3, 3), dtype=int)
+    for i in range(iuq):
+        op = ops[i,:,:]
+        rcell = op@uq_hnf[i,:,:].T@parent_lattice
 
         if np.linalg.det(rcell) <0:
-            tras_matrix=-1*op@uq_hnf[i,:,:].T
+            trans[i,:,:]=-1*op@uq_hnf[i,:,:].T
         else:
-            trans_matrix=op@uq_hnf[i,:,:].T
+            trans[i,:,:]=op@uq_hnf[i,:,:].T
+
+    return trans
+
+
+def degenerate_supercells(trans, parent_lattice, shell_distances, shell_images):
+    """
+    Supercells that provably cannot separate the given shells of the parent.
+
+    shell_images[s] is None if shell s (at distance shell_distances[s])
+    couples different magnetic sites of the parent; otherwise it holds the
+    lattice vectors R (in the parent basis) of all its bonds, each site
+    being coupled only to its own images. If all these R are lattice
+    vectors of a supercell, every bond of the shell couples a site to its
+    own image there, so the column of the shell is constant and dependent
+    on the first one: the shell is not resolved.
+
+    The shortest vector of the (Minkowski-reduced) supercell lattice is its
+    shortest basis vector; when it is longer than the shell, R cannot be a
+    supercell vector and the integer test is skipped. Otherwise R is a
+    vector of the lattice spanned by the rows of trans when R adj(trans) is
+    divisible by det(trans).
+    """
+    shortest = np.min(np.linalg.norm(trans @ parent_lattice, axis=2), axis=1)
+    degenerate = np.zeros(len(trans), dtype=bool)
+    for i, T in enumerate(trans):
+        det = int(round(np.linalg.det(T)))
+        adj = np.rint(np.linalg.inv(T) * det).astype(np.int64)
+        for dist, images in zip(shell_distances, shell_images):
+            if images is None or shortest[i] > dist + 1e-3:
+                continue
+            if np.all((images @ adj) % det == 0):
+                degenerate[i] = True
+                break
+    return degenerate
+
+
+def supercell_filename(struct_dir, vol, i):
+    return struct_dir+"/"+"cell-vol"+str(vol)+"-num"+str(i)+".vasp"
+
+
+class Supercell:
+    """
+    Compact description of a supercell of the parent structure: volume vol,
+    number num, HNF of its lattice (columns in the parent basis), Minkowski
+    reduction matrix op and transformation matrix trans (as used by
+    SupercellTransformation). The Structure is only built on demand.
+    """
+    __slots__ = ("vol", "num", "hnf", "op", "trans")
+
+    def __init__(self, vol, num, hnf, op, trans):
+        self.vol = vol
+        self.num = num
+        self.hnf = np.asarray(hnf, dtype=np.int32)
+        self.op = np.asarray(op, dtype=np.int32)
+        self.trans = np.asarray(trans, dtype=np.int32)
+
+    def lattice(self, parent_lattice):
+        """Lattice matrix of the supercell (one vector per row)."""
+        return self.trans @ parent_lattice
+
+    def structure(self, parent):
+        """The supercell of the Structure parent."""
+        return _make_supercell(parent, self.trans)
+
+
+def write_supercells(supercells, parent, struct_dir="supercells", num_threads=8):
+    """
+    Build the Supercells of the Structure parent and write them as POSCAR
+    files named by supercell_filename, on a pool of threads (the writes
+    are I/O bound).
+    """
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [executor.submit(_make_supercell, parent, supercell.trans, supercell_filename(struct_dir, supercell.vol, supercell.num)) for supercell in supercells]
+        for future in futures:
+            future.result()
+
+
+def _make_supercell(structure, trans_matrix, filename=None):
+    supercell=SupercellTransformation(trans_matrix)
+    new_structure = supercell.apply_transformation(structure)
+    if filename is not None:
+        new_structure.to(fmt = 'poscar', filename = filename)
+    return new_structure
 
-        supercell=SupercellTransformation(trans_matrix)
-        
-        new_structure.append(supercell.apply_transformation(structure))
 
-        if write_str:
-            new_structure[-1].to(fmt = 'poscar', filename = struct_dir+"/"+"cell-vol"+str(vol)+"-num"+str(i)+".vasp")
-        if verbosity=='high' or verbosity=='medium':
-            logfile.write(f"-----volume: {vol} Structure number:{i}-----\n")
-            logfile.write(f"HNF matrix:\n")
-            for j in range(3):
-                 #logfile.write(f"{uq_hnf[i,j,0]:3d} {uq_hnf[i,j,1]:3d} {uq_hnf[i,j,2]:3d}\n")
-                 logfile.write("%3d %3d %3d \n" % (uq_hnf[i,j,0], uq_hnf[i,j,1], uq_hnf[i,j,2]))
+def _write_supercell(structure, trans_matrix, filename):
+    # Pool task: nothing is sent back to the parent process
+    _make_supercell(structure, trans_matrix, filename)
+
+
+def write_supercell_log(uq_hnf, iuq, vol, ops, trans, verbosity='low'):
+    if not (verbosity=='high' or verbosity=='medium'):
+        return
+
+    logfile=open('log.txt', 'a+')
+
+    for i in range(iuq):
+        op = ops[i,:,:]
+        trans_matrix = trans[i,:,:]
+        logfile.write(f"-----volume: {vol} Structure number:{i}-----\n")
+        logfile.write(f"HNF matrix:\n")
+        for j in range(3):
+             #logfile.write(f"{uq_hnf[i,j,0]:3d} {uq_hnf[i,j,1]:3d} {uq_hnf[i,j,2]:3d}\n")
+             logfile.write("%3d %3d %3d \n" % (uq_hnf[i,j,0], uq_hnf[i,j,1], uq_hnf[i,j,2]))
         if verbosity=='high':
             logfile.write(f"Minkowski reduce matrix\n")
             for j in range(3):
@@ -160,14 +473,7 @@ def supercells(structure,struct_dir, uq_hnf, iuq, vol, parent_lattice, LatDim, w
             for j in range(3):
                  logfile.write(f"{trans_matrix[j,0]:3d} {trans_matrix[j,1]:3d} {trans_matrix[j,2]:3d}\n")
 
-    if verbosity=='high' or verbosity=='medium':
-        logfile.close()    
-
-            
-
-
-    return new_structure
-
+    logfile.close()    
 
 
 #struc_file="MnTe.vasp"
@@ -0,0 +1,104 @@
+######################################################################
+# This routine is part of
+# SUPERHEX - Supercell Optimization for Heisenberg Exchange Calculations 
+# (c) 2024-2025  Dr. Mojtaba Alaei and  Dr. Nafise Rezaei
+# Physics Department, Isfahan University of Technology, Isfahan, Iran
+#
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License as published by the 
+# Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY 
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License 
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along 
+# with this program. If not, see http://www.gnu.org/licenses. 
+#######################################################################
+
+# On-disk cache of the unique HNF matrices of a volume.
+#
+# The unique HNF set only depends on the point-group operations written as
+# integer matrices in the parent-lattice basis, on LatDim and on the volume,
+# so it is shared by every material with the same space-group setting.
+# The Minkowski transformation matrices also depend on the metric of the
+# parent lattice, so they are stored in a second file keyed by the lattice.
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "superhex")
+
+
+def hnf_cache_key(int_rot, LatDim, vol, dedupe_method):
+    """
+    Content hash of the integer point-group operations (as returned by
+    integer_rotations, i.e. sorted and unique), LatDim, volume and dedupe
+    method.
+    """
+    h = hashlib.sha256()
+    h.update(f"v{CACHE_VERSION}-dim{LatDim}-vol{vol}-{dedupe_method}".encode())
+    h.update(np.ascontiguousarray(int_rot, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+def lattice_key(parent_lattice):
+    """Hash of the parent lattice matrix (rounded to 1e-5 Angstrom)."""
+    latt = np.round(np.asarray(parent_lattice, dtype=float), 5) + 0.0  # drop -0.0
+    return hashlib.sha256(latt.tobytes()).hexdigest()[:16]
+
+
+def _load(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+    except (OSError, ValueError):
+        # Corrupted or truncated cache file: treat as a miss
+        return None
+
+
+def _save(path, **arrays):
+    """Write atomically, so that concurrent runs never read a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_unique_hnf(cache_dir, key):
+    data = _load(os.path.join(cache_dir, f"hnf-{key}.npz"))
+    if data is None:
+        return None
+    return data["hnf"].astype(int)
+
+
+def save_unique_hnf(cache_dir, key, uq_hnf):
+    _save(os.path.join(cache_dir, f"hnf-{key}.npz"), hnf=np.asarray(uq_hnf, dtype=np.int32))
+
+
+def load_minkowski_ops(cache_dir, key, parent_lattice):
+    data = _load(os.path.join(cache_dir, f"mink-{key}-{lattice_key(parent_lattice)}.npz"))
+    if data is None:
+        return None
+    return data["ops"].astype(int)
+
+
+def save_minkowski_ops(cache_dir, key, parent_lattice, ops):
+    _save(os.path.join(cache_dir, f"mink-{key}-{lattice_key(parent_lattice)}.npz"), ops=np.asarray(ops, dtype=np.int32))
@@ -19,6 +19,7 @@
 #######################################################################
 
 import numpy as np
+import numba
 
 def get_HNF_diagonals(volume):
     id = 0  # Number of diagonals found
@@ -37,34 +38,44 @@ def get_HNF_diagonals(volume):
     diagonals = np.array(tempDiag).T  # Convert list to NumPy array and transpose
     return diagonals
 
+def _HNF_block(a, b, c, start, stop):
+    """
+    HNFs number start..stop-1 of the diagonal (a, b, c), built at once with
+    broadcasting over the flattened (j, k, l) index grid. The order is the
+    one of the nested loops j -> k -> l (l fastest), as in enumlib.
+    """
+    idx = np.arange(start, stop)
+    hnf = np.zeros((len(idx), 3, 3), dtype=int)
+    # Lower triangular: transpose of [[a, j, k], [0, b, l], [0, 0, c]]
+    hnf[:, 0, 0] = a
+    hnf[:, 1, 1] = b
+    hnf[:, 2, 2] = c
+    hnf[:, 1, 0] = idx // (c * c)       # j
+    hnf[:, 2, 0] = (idx // c) % c       # k
+    hnf[:, 2, 1] = idx % c              # l
+    return hnf
+
+def iter_HNFs(volume, chunk_size=4096):
+    """
+    Generate all 3D HNFs of the given volume in chunks of at most
+    chunk_size matrices, in the same order as get_all_HNFs.
+    """
+    d = get_HNF_diagonals(volume)
+    for i in range(d.shape[1]):  # Loop over the permutations of the diagonal elements of the HFNs
+        a, b, c = d[:, i]
+        n = b * c ** 2
+        for start in range(0, n, chunk_size):
+            yield _HNF_block(a, b, c, start, min(start + chunk_size, n))
+
 def get_all_HNFs(volume):
     d = get_HNF_diagonals(volume)
-    N = d.shape[1]
 
     # Count the total number of HNF matrices for the given determinant (volume)
-    Nhnf = 0
-    for i in range(N):
-        Nhnf += d[1, i] * d[2, i] ** 2
-
-    hnf = np.zeros((Nhnf, 3, 3), dtype=int)
-    ihnf = 0
-
-    for i in range(N):  # Loop over the permutations of the diagonal elements of the HFNs
-        for j in range(d[1, i]):  # Loop over possible values of row 2, element 1
-            for k in range(d[2, i]):  # Loop over possible values of row 3, element 1
-                for l in range(d[2, i]):  # Loop over possible values of row 3, element 2
-                    #hnf[ihnf, :, :] = np.array([[d[0, i], j, k], [0, d[1, i], l], [0, 0, d[2, i]]])
-                     #FORTRAN from enumlib
-                     #hnf(:,:,ihnf) = reshape((/ d(1,i),      j,     k,        &
-                     #0, d(2,i),     l,        &
-                     #0,      0, d(3,i)  /), (/3,3/))
-                     # The reshape in fortan creat a lower trigonal matrix; it takes each three number and 
-                     # put them in the columns, ...So to generate the same, we need to transpose the matrix
-
-                    hnf[ihnf, :, :] = np.array([[d[0, i], j, k], [0, d[1, i], l], [0, 0, d[2, i]]]).T
-                    ihnf += 1
-
-    if ihnf != Nhnf:
+    Nhnf = np.sum(d[1, :] * d[2, :] ** 2)
+
+    hnf = np.concatenate([_HNF_block(a, b, c, 0, b * c ** 2) for a, b, c in d.T])
+
+    if hnf.shape[0] != Nhnf:
         raise ValueError("HNF: not all the matrices were generated... (bug!)")
 
     return hnf
@@ -81,32 +92,137 @@ def get_HNF_2D_diagonals(volume):
     return diagonals
 
 
+def _2D_HNF_block(d0, d1, d2, start, stop):
+    """
+    2D HNFs number start..stop-1 of the diagonal (d0, d1, d2); the third
+    lattice vector is left untouched.
+    """
+    j = np.arange(start, stop)
+    hnf = np.zeros((len(j), 3, 3), dtype=int)
+    # Transpose of [[d2, j, 0], [0, d1, 0], [0, 0, d0]], with 0 <= j < d1 so
+    # that j is reduced modulo the diagonal element of its own row
+    hnf[:, 0, 0] = d2
+    hnf[:, 1, 1] = d1
+    hnf[:, 2, 2] = d0
+    hnf[:, 1, 0] = j
+    return hnf
+
+def iter_2D_HNFs(volume, chunk_size=4096):
+    """
+    Generate all 2D HNFs of the given volume in chunks of at most
+    chunk_size matrices, in the same order as get_all_2D_HNFs.
+    """
+    d = get_HNF_2D_diagonals(volume)
+    for i in range(d.shape[1]):
+        d0, d1, d2 = d[:, i]
+        for start in range(0, d1, chunk_size):
+            yield _2D_HNF_block(d0, d1, d2, start, min(start + chunk_size, d1))
+
 def get_all_2D_HNFs(volume):
     d = get_HNF_2D_diagonals(volume)
-    N = d.shape[1]
 
     # Count the total number of HNF matrices for the given determinant (volume)
-    Nhnf = sum(d[2, :])
-
-    hnf = np.zeros((Nhnf, 3, 3), dtype=int)
-    ihnf = 0
+    Nhnf = sum(d[1, :])
 
-    for i in range(N):  # Loop over the permutations of the diagonal elements of the HFNs
-        for j in range(d[2, i]):  # Loop over possible values of row 2, element 1
-            hnf[ihnf,:, :] = np.array([
-                [d[2, i], j, 0],
-                [0, d[1, i], 0],
-                [0, 0, d[0, i]]
-            ]).T
-            ihnf += 1  # Count the HNFs and construct the next one
+    hnf = np.concatenate([_2D_HNF_block(d0, d1, d2, 0, d1) for d0, d1, d2 in d.T])
 
-    if ihnf != Nhnf:
+    if hnf.shape[0] != Nhnf:
         raise ValueError("HNF: not all the matrices were generated...(bug!)")
 
     return hnf
 
 
 
+@numba.njit(cache=True)
+def hermite_normal_form(M):
+    """
+    Lower-triangular (column) Hermite normal form of a nonsingular 3x3
+    integer matrix, in the same convention as get_all_HNFs: the columns
+    span the lattice, H[i, i] > 0 and 0 <= H[i, j] < H[i, i] for j < i.
+    """
+    H = M.copy()
+    # Column-wise Euclid: clear the entries right of the diagonal, row by row
+    for i in range(3):
+        for j in range(i + 1, 3):
+            while H[i, j] != 0:
+                q = H[i, i] // H[i, j]
+                for r in range(3):
+                    tmp = H[r, i] - q * H[r, j]
+                    H[r, i] = H[r, j]
+                    H[r, j] = tmp
+        if H[i, i] < 0:
+            for r in range(3):
+                H[r, i] = -H[r, i]
+    # Reduce the entries left of the diagonal modulo the diagonal element
+    for i in range(1, 3):
+        for j in range(i):
+            q = H[i, j] // H[i, i]
+            for r in range(3):
+                H[r, j] -= q * H[r, i]
+    return H
+
+
+@numba.njit(cache=True)
+def _lex_less(A, B):
+    for a in range(3):
+        for b in range(3):
+            if A[a, b] != B[a, b]:
+                return A[a, b] < B[a, b]
+    return False
+
+
+@numba.njit(cache=True)
+def canonical_hnf(hnf, int_rot):
+    """
+    Canonical representative of the orbit of an HNF under the point group:
+    the lexicographically smallest HNF(R @ hnf) over all integer rotations
+    R (given in the parent-lattice basis).
+    """
+    best = hnf.copy()
+    first = True
+    RH = np.zeros((3, 3), dtype=hnf.dtype)
+    for irot in range(int_rot.shape[0]):
+        for a in range(3):
+            for b in range(3):
+                acc = 0
+                for c in range(3):
+                    acc += int_rot[irot, a, c] * hnf[c, b]
+                RH[a, b] = acc
+        H = hermite_normal_form(RH)
+        if first or _lex_less(H, best):
+            best = H
+            first = False
+    return best
+
+
+
+@numba.njit(cache=True)
+def count_hnf_fixed_points(hnf, int_rot):
+    """
+    For every integer rotation R, count the HNFs of the stack hnf (n, 3, 3)
+    whose lattice is invariant under R, i.e. HNF(R @ H) == H.
+    """
+    nrot = int_rot.shape[0]
+    fixed = np.zeros(nrot, dtype=np.int64)
+    RH = np.zeros((3, 3), dtype=hnf.dtype)
+    for i in range(hnf.shape[0]):
+        for irot in range(nrot):
+            for a in range(3):
+                for b in range(3):
+                    acc = 0
+                    for c in range(3):
+                        acc += int_rot[irot, a, c] * hnf[i, c, b]
+                    RH[a, b] = acc
+            H = hermite_normal_form(RH)
+            same = True
+            for a in range(3):
+                for b in range(3):
+                    if H[a, b] != hnf[i, a, b]:
+                        same = False
+            if same:
+                fixed[irot] += 1
+    return fixed
+
 if __name__ == "__main__":
     print("HNFs for vol=4 for 3D")
     print(get_all_HNFs(4))
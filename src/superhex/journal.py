@@ -0,0 +1,101 @@
+######################################################################
+# This routine is part of
+# SUPERHEX - Supercell Optimization for Heisenberg Exchange Calculations 
+# (c) 2024-2025  Dr. Mojtaba Alaei and  Dr. Nafise Rezaei
+# Physics Department, Isfahan University of Technology, Isfahan, Iran
+#
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License as published by the 
+# Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY 
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License 
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along 
+# with this program. If not, see http://www.gnu.org/licenses. 
+#######################################################################
+
+
+# Append-only journal of the supercell analyses (one JSON object per line).
+#
+# Every record is written and flushed to disk as soon as the analysis of a
+# supercell finishes, so that an interrupted run loses nothing and can be
+# resumed. A record is identified by the analysis settings (see
+# settings_key), the volume and the HNF of the supercell lattice, which
+# does not depend on the numbering of the supercells: a run over a larger
+# range of volumes reuses the results of a previous, smaller one.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+JOURNAL_VERSION = 1
+
+# input.txt keys that change the result of the analysis of a supercell (the
+# supercell numbering, hence the random seeds, depends on dedupe_method)
+ANALYSIS_KEYS = ("LatDim", "dedupe_method", "cutoff_radius", "magnetic_atoms", "n_configs", "all_configs", "seed",
+                 "adaptive_configs", "config_batch", "saturation_batches", "system_engine", "rank_method")
+
+
+def settings_key(config, structure):
+    """Hash of the parent structure and of the analysis settings of config."""
+    settings = {key: getattr(config, key) for key in ANALYSIS_KEYS}
+    settings["version"] = JOURNAL_VERSION
+    settings["lattice"] = np.round(structure.lattice.matrix, 5).tolist()
+    settings["frac_coords"] = np.round(structure.frac_coords, 5).tolist()
+    settings["species"] = [site.species_string for site in structure]
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def _json_default(obj):
+    # numpy scalars and arrays in struct_info
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def load_journal(path, key):
+    """
+    Records of the journal at path with the settings key, as a dict
+    {(volume, HNF as a tuple): record}. A truncated last line (interrupted
+    write) is ignored.
+    """
+    records = {}
+    if path is None or not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("key") == key:
+                records[(record["vol"], tuple(record["hnf"]))] = record
+    return records
+
+
+def open_journal(path):
+    """Open the journal for appending, starting a new line after a truncated one."""
+    f = open(path, "a+")
+    if f.tell() > 0:
+        f.seek(f.tell() - 1)
+        if f.read(1) != "\n":
+            f.write("\n")
+    return f
+
+
+def append_record(f, key, vol, hnf, struct_info, output):
+    """Append one analysis to the open journal f and force it to disk."""
+    record = {"key": key, "vol": int(vol), "hnf": [int(x) for x in np.ravel(hnf)],
+              "struct_info": struct_info, "output": output}
+    f.write(json.dumps(record, default=_json_default) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+    return record
@@ -0,0 +1,177 @@
+######################################################################
+# This routine is part of
+# SUPERHEX - Supercell Optimization for Heisenberg Exchange Calculations 
+# (c) 2024-2025  Dr. Mojtaba Alaei and  Dr. Nafise Rezaei
+# Physics Department, Isfahan University of Technology, Isfahan, Iran
+#
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License as published by the 
+# Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY 
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License 
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along 
+# with this program. If not, see http://www.gnu.org/licenses. 
+#######################################################################
+
+# Exact rank and column rank profile of integer matrices by row reduction
+# modulo several primes.
+#
+# Over a prime p, the rank of every leading block of columns A[:, :j] is a
+# lower bound of its rank over the rationals, and it is exact unless p
+# divides every nonzero minor of that block. Using primes whose product is
+# larger than the Hadamard bound of the matrix (a bound on the absolute
+# value of every minor) guarantees that, for every j, at least one prime
+# gives the exact rank of A[:, :j]. Taking the maximum over the primes thus
+# gives the exact column rank profile: the rank, the pivot (independent)
+# columns and the first dependent column, as the nullspace over QQ would.
+
+import numpy as np
+import numba
+
+
+@numba.njit(cache=True)
+def _inv_mod(a, p):
+    # a^(p-2) mod p (Fermat); all products stay below 2^62 for p < 2^31
+    result = 1
+    e = p - 2
+    while e > 0:
+        if e & 1:
+            result = (result * a) % p
+        a = (a * a) % p
+        e >>= 1
+    return result
+
+
+@numba.njit(cache=True)
+def pivot_columns_mod_p(A, p):
+    """
+    Row echelon form of A (2D int64 array, entries already in [0, p))
+    modulo the prime p. Returns a boolean array, True for pivot columns.
+    A is overwritten.
+    """
+    m, n = A.shape
+    pivots = np.zeros(n, dtype=np.bool_)
+    r = 0
+    for j in range(n):
+        if r == m:
+            break
+        piv = -1
+        for i in range(r, m):
+            if A[i, j] != 0:
+                piv = i
+                break
+        if piv < 0:
+            continue
+        if piv != r:
+            for k in range(j, n):
+                tmp = A[r, k]
+                A[r, k] = A[piv, k]
+                A[piv, k] = tmp
+        inv = _inv_mod(A[r, j], p)
+        for k in range(j, n):
+            A[r, k] = (A[r, k] * inv) % p
+        for i in range(r + 1, m):
+            f = A[i, j]
+            if f != 0:
+                for k in range(j, n):
+                    A[i, k] = (A[i, k] - f * A[r, k]) % p
+        pivots[j] = True
+        r += 1
+    return pivots
+
+
+def _is_prime(n):
+    if n < 2:
+        return False
+    i = 2
+    while i * i <= n:
+        if n % i == 0:
+            return False
+        i += 1
+    return True
+
+
+_primes = []
+
+def large_primes(k):
+    """The k largest primes below 2^31 (computed once and kept)."""
+    candidate = _primes[-1] - 2 if _primes else 2**31 - 1
+    while len(_primes) < k:
+        if _is_prime(candidate):
+            _primes.append(candidate)
+        candidate -= 2
+    return _primes[:k]
+
+
+def hadamard_bound_bits(A):
+    """log2 of a bound on the absolute value of every minor of A."""
+    norms = np.sqrt(np.sum(A.astype(float)**2, axis=1))
+    norms = np.sort(norms[norms > 1.0])[::-1][:min(A.shape)]
+    return float(np.sum(np.log2(norms)))
+
+
+def rank_profile(A):
+    """
+    Exact rank, pivot columns and first dependent column of an integer
+    matrix.
+
+    Parameters:
+    A : numpy.ndarray
+        2D integer matrix.
+
+    Returns:
+    rank : int
+        Rank of A over the rationals.
+    pivots : numpy.ndarray
+        Indices of the pivot columns (each is independent of the columns
+        on its left).
+    first_dep_col : int
+        Index of the first column that is a linear combination of the
+        columns on its left; A.shape[1] if all the columns are independent.
+    """
+    A = np.asarray(A, dtype=np.int64)
+    m, n = A.shape
+
+    nprime = int(np.ceil((hadamard_bound_bits(A) + 1.0) / 30.0))  # every prime is > 2^30
+    prefix_rank = np.zeros(n, dtype=np.int64)
+    for p in large_primes(max(nprime, 2)):
+        pivots_p = pivot_columns_mod_p(A % p, p)
+        # Rank of A[:, :j+1] modulo p, a lower bound of the exact one
+        prefix_rank = np.maximum(prefix_rank, np.cumsum(pivots_p))
+
+    increments = np.diff(np.concatenate(([0], prefix_rank)))
+    pivots = np.flatnonzero(increments)
+    dependent = np.flatnonzero(increments == 0)
+    first_dep_col = int(dependent[0]) if len(dependent) else n
+
+    return int(prefix_rank[-1]) if n else 0, pivots, first_dep_col
+
+
+@numba.njit(cache=True)
+def echelon_insert_mod_p(E, pivcol, rank, row, p):
+    """
+    Incremental row echelon form modulo p. E holds `rank` basis rows (pivot
+    entry 1 in column pivcol[b], zero in the pivot columns of the previous
+    rows). row (entries in [0, p)) is reduced against them and appended if
+    it is independent. Returns the new rank.
+    """
+    n = row.shape[0]
+    v = row.copy()
+    for b in range(rank):
+        f = v[pivcol[b]]
+        if f != 0:
+            for k in range(n):
+                v[k] = (v[k] - f * E[b, k]) % p
+    for j in range(n):
+        if v[j] != 0:
+            inv = _inv_mod(v[j], p)
+            for k in range(n):
+                E[rank, k] = (v[k] * inv) % p
+            pivcol[rank] = j
+            return rank + 1
+    return rank
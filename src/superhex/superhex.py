@@ -18,19 +18,23 @@
 # with this program. If not, see http://www.gnu.org/licenses. 
 #######################################################################
 import numpy as np
-import sympy as sy
 import pandas as pd
 from pymatgen.core.structure import Structure
 import json
+import os
+import tempfile
+import argparse
 from types import SimpleNamespace
-from  itertools import product
 from multiprocessing import Pool
 import numba 
 from tqdm import tqdm
-from sympy.polys.matrices import DomainMatrix
 
 
-from superhex.generate_supercell import generate_structures
+from superhex.generate_supercell import generate_structures, estimate_workload, write_supercells, Supercell
+from superhex.hnf_lib import hermite_normal_form
+from superhex.rank_lib import rank_profile, echelon_insert_mod_p, large_primes
+from superhex.journal import settings_key, load_journal, open_journal, append_record
+from superhex.worker_data import publish_parent, attach_parent
 
 
 #read input file:
@@ -41,24 +45,92 @@ def read_input(inputname):
         inp = SimpleNamespace(**data)
     return inp
 
-def get_variables():
-    global struc_file, LatDim, magnetic_atoms, cutoff_radius, nconf, all_configs, verbo, seed, num_processes, volumes 
-    inp = read_input("input.txt")
-    struc_file = inp.structure_file
-    LatDim = inp.LatDim
-    magnetic_atoms = inp.magnetic_atoms
-    cutoff_radius = inp.cutoff_radius
-    nconf = inp.n_configs
-    all_configs = inp.all_configs
-    verbo = inp.verbosity
-    seed = inp.seed
-    num_processes = inp.num_processes
-    if inp.range_volume:
-        volumes = list(range(inp.volumes[0], inp.volumes[1] + 1))
+# Default values of the optional keys of input.txt
+optional_inputs = {
+    "dedupe_method": "tolerance",
+    "use_cache": False,
+    "cache_dir": None,
+    "adaptive_configs": False,
+    "config_batch": 10,
+    "saturation_batches": 3,
+    "system_engine": "auto",
+    "rank_method": "configurations",
+    "max_memory_per_worker": 1024,
+    "target_J": None,
+    "prefilter_shells": None,
+    "journal": "struct_analysis.jsonl",
+    "write_supercells": "all",
+    "write_filter": None,
+}
+
+def get_variables(inp):
+    """
+    Complete an input namespace (or dict) with the default values of the
+    optional keys and expand 'volumes' into the list of volumes to scan.
+    """
+    if isinstance(inp, dict):
+        inp = SimpleNamespace(**inp)
+    config = SimpleNamespace(**{**optional_inputs, **vars(inp)})
+    if config.range_volume:
+        config.volumes = list(range(inp.volumes[0], inp.volumes[1] + 1))
     else:
-        volumes = inp.volumes
+        config.volumes = list(inp.volumes)
+
+    # Checked now rather than after the analysis of every supercell
+    if config.write_supercells != "all":
+        try:
+            config.write_supercells = int(config.write_supercells)
+        except (TypeError, ValueError):
+            raise ValueError(f"write_supercells must be \"all\" or an integer, not {config.write_supercells!r}")
+    if config.write_filter is not None:
+        try:
+            analysis_dataframe([]).query(config.write_filter)
+        except Exception as e:
+            raise ValueError(f"Invalid write_filter {config.write_filter!r}: {e}") from e
+    return config
+
 
-get_variables()
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="SUPERHEX - Supercell Optimization for Heisenberg Exchange Calculations (reads input.txt)")
+    parser.add_argument('-i', '--input_file', type=str, default='input.txt',
+                        help='Path to the input file (default: input.txt)')
+    parser.add_argument('--estimate', action='store_true',
+                        help='Only predict the number of inequivalent supercells, magnetic sites and neighbor pairs per volume (no supercell is built)')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Only rebuild struct_analysis.csv from the journal of the analyses (nothing is computed)')
+    args = parser.parse_args()
+    return args
+
+
+@numba.njit
+def shell_csr(unique_distances, distances):
+    """
+    Group the neighbor pairs by shell in CSR layout: the pairs of shell i are
+    shell_pairs[shell_ptr[i]:shell_ptr[i+1]]. A pair belongs to every shell
+    with |distance - unique_distance| < 0.001 (usually exactly one).
+    """
+    num_distances = len(unique_distances)
+    num_pairs = len(distances)
+    # Candidate shells of every pair, found by bisection in the sorted shells
+    first = np.searchsorted(unique_distances, distances - 0.0011)
+    counts = np.zeros(num_distances + 1, dtype=np.int64)
+    for j in range(num_pairs):
+        i = first[j]
+        while i < num_distances and unique_distances[i] < distances[j] + 0.0011:
+            if np.abs(distances[j] - unique_distances[i]) < 0.001:
+                counts[i + 1] += 1
+            i += 1
+    shell_ptr = np.cumsum(counts)
+    shell_pairs = np.zeros(shell_ptr[-1], dtype=np.int64)
+    fill = shell_ptr[:-1].copy()
+    for j in range(num_pairs):
+        i = first[j]
+        while i < num_distances and unique_distances[i] < distances[j] + 0.0011:
+            if np.abs(distances[j] - unique_distances[i]) < 0.001:
+                shell_pairs[fill[i]] = j
+                fill[i] += 1
+            i += 1
+    return shell_ptr, shell_pairs
 
 
 @numba.njit(parallel=True)
@@ -66,183 +138,951 @@ def system(configurations, unique_distances, center_indices, point_indices, dist
     num_distances = len(unique_distances)
     num_configs = len(configurations)
     matrix = np.ones((num_configs, num_distances + 1), dtype=np.int32)
+
+    # Each pair is assigned to its shell once; no (configs x pairs) product is stored
+    shell_ptr, shell_pairs = shell_csr(unique_distances, distances)
     
-    # Precompute the product of configurations at the specified indices
-    config_product = configurations[:, center_indices] * configurations[:, point_indices]
-    
-    for i in numba.prange(num_distances):
-        distance = unique_distances[i]
-        close_indices = np.abs(distances - distance) < 0.001
-        interaction_counts = np.zeros(num_configs, dtype=np.int32)
-        for j in range(len(close_indices)):
-            if close_indices[j]:
-                interaction_counts += config_product[:, j]
-        matrix[:, i + 1] = -interaction_counts // 2
+    for c in numba.prange(num_configs):
+        conf = configurations[c]
+        for i in range(num_distances):
+            interaction_counts = 0
+            for k in range(shell_ptr[i], shell_ptr[i + 1]):
+                j = shell_pairs[k]
+                interaction_counts += conf[center_indices[j]] * conf[point_indices[j]]
+            matrix[c, i + 1] = -interaction_counts
     
     return matrix
 
 
+@numba.njit
+def shell_pair_matrices(natom, unique_distances, center_indices, point_indices, distances):
+    """
+    Pair-multiplicity matrices of the shells: M[s, i, j] is the number of
+    pairs (i, j) (all periodic images) of the half neighbor list in shell s,
+    so that row c of the A matrix is 1, -conf_c^T M[s] conf_c for every
+    shell s.
+    """
+    num_distances = len(unique_distances)
+    shell_ptr, shell_pairs = shell_csr(unique_distances, distances)
+    M = np.zeros((num_distances, natom, natom), dtype=np.int32)
+    for i in range(num_distances):
+        for k in range(shell_ptr[i], shell_ptr[i + 1]):
+            j = shell_pairs[k]
+            M[i, center_indices[j], point_indices[j]] += 1
+    return M
+
+
+def blas_shell_block(natom):
+    """Shells per matrix product in system_blas: at most 64 MB of float64 matrices."""
+    return max(1, 2**23 // (natom * natom))
+
+
+def system_blas(configurations, M):
+    """
+    Same A matrix as system, evaluated from the shell matrices M (see
+    shell_pair_matrices) as batched quadratic forms with matrix products.
+    """
+    num_configs = len(configurations)
+    num_distances, natom, _ = M.shape
+    matrix = np.ones((num_configs, num_distances + 1), dtype=np.int32)
+
+    X = np.asarray(configurations, dtype=np.float64)
+    block = blas_shell_block(natom)
+    for s0 in range(0, num_distances, block):
+        Mb = M[s0:s0 + block].astype(np.float64)
+        nb = Mb.shape[0]
+        # Y[c, s, :] = conf_c^T M[s], for all shells of the block in one product
+        Y = (X @ Mb.transpose(1, 0, 2).reshape(natom, nb * natom)).reshape(num_configs, nb, natom)
+        Q = np.einsum('csn,cn->cs', Y, X)
+        matrix[:, s0 + 1:s0 + 1 + nb] = -np.rint(Q).astype(np.int64)
+
+    return matrix
+
+
+def random_packed_configs(rng, num_configs, natom):
+    """
+    num_configs random configurations of natom spins, packed into uint64
+    words: bit i of a configuration is set when spin i is -1 (one word per
+    64 sites).
+    """
+    nwords = (natom + 63) // 64
+    packed = rng.integers(0, np.iinfo(np.uint64).max, (num_configs, nwords), dtype=np.uint64, endpoint=True)
+    if natom % 64:
+        packed[:, -1] &= np.uint64((1 << (natom % 64)) - 1)
+    return packed
+
+
+def shell_pair_masks(natom, unique_distances, center_indices, point_indices, distances):
+    """
+    Neighbor bit masks of the shells: bit j of masks[s, i, m] is set when
+    the pair (i, j) appears more than m times (periodic images) in shell s,
+    so that the multiplicity of (i, j) is the number of layers m where it is
+    set. nlayer[s, i] is the number of non-empty layers and npairs[s] the
+    number of pairs of shell s.
+    """
+    num_distances = len(unique_distances)
+    nwords = (natom + 63) // 64
+    shell_ptr, shell_pairs = shell_csr(unique_distances, distances)
+    shell_of = np.repeat(np.arange(num_distances), np.diff(shell_ptr))
+    key = (shell_of*natom + center_indices[shell_pairs])*natom + point_indices[shell_pairs]
+    key, mult = np.unique(key, return_counts=True)
+    s, rest = np.divmod(key, natom*natom)
+    i, j = np.divmod(rest, natom)
+
+    nlayer = np.zeros((num_distances, natom), dtype=np.int64)
+    np.maximum.at(nlayer, (s, i), mult)
+    masks = np.zeros((num_distances, natom, max(1, int(mult.max(initial=0))), nwords), dtype=np.uint64)
+    bit = np.left_shift(np.uint64(1), (j % 64).astype(np.uint64))
+    for m in range(masks.shape[2]):
+        sel = mult > m
+        np.bitwise_or.at(masks, (s[sel], i[sel], m, j[sel] // 64), bit[sel])
+
+    return masks, nlayer, np.diff(shell_ptr)
+
+
+@numba.njit(inline='always')
+def _popcount64(x):
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return np.int64((x * np.uint64(0x0101010101010101)) >> np.uint64(56))
+
+
+@numba.njit(parallel=True)
+def system_bits(packed, masks, nlayer, npairs):
+    """
+    Same A matrix as system, for packed configurations (see random_packed_configs)
+    and the neighbor masks of shell_pair_masks: a pair (i, j) is
+    antiparallel when bit i XOR bit j is set, so that the sum of s_i s_j
+    over a shell is npairs - 2 * (number of antiparallel pairs).
+    """
+    num_configs, nwords = packed.shape
+    num_distances, natom = nlayer.shape
+    matrix = np.ones((num_configs, num_distances + 1), dtype=np.int32)
+    zero = np.uint64(0)
+
+    for c in numba.prange(num_configs):
+        conf = packed[c]
+        anti = np.zeros(num_distances, dtype=np.int64)
+        flipped = np.empty(nwords, dtype=np.uint64)
+        for i in range(natom):
+            # conf XOR (bit i repeated): the bits set are the spins antiparallel to i
+            if (conf[i // 64] >> np.uint64(i % 64)) & np.uint64(1):
+                for w in range(nwords):
+                    flipped[w] = ~conf[w]
+            else:
+                for w in range(nwords):
+                    flipped[w] = conf[w]
+            for s in range(num_distances):
+                for m in range(nlayer[s, i]):
+                    for w in range(nwords):
+                        x = flipped[w] & masks[s, i, m, w]
+                        if x != zero:
+                            anti[s] += _popcount64(x)
+        for s in range(num_distances):
+            matrix[c, s + 1] = -(npairs[s] - 2*anti[s])
+
+    return matrix
+
+
+@numba.njit
+def site_shell_neighbors(natom, unique_distances, center_indices, point_indices, distances):
+    """
+    Neighbors of every site, for the single spin flips of all_configs_orbits:
+    entries site_ptr[k]:site_ptr[k+1] of site_nbr and site_shell are the
+    sites j != k and shells of all the pairs (k, j) or (j, k) of the half
+    neighbor list. npairs[s] is the number of pairs of shell s.
+    """
+    num_distances = len(unique_distances)
+    shell_ptr, shell_pairs = shell_csr(unique_distances, distances)
+    counts = np.zeros(natom + 1, dtype=np.int64)
+    for i in range(num_distances):
+        for k in range(shell_ptr[i], shell_ptr[i + 1]):
+            j = shell_pairs[k]
+            if center_indices[j] != point_indices[j]:
+                counts[center_indices[j] + 1] += 1
+                counts[point_indices[j] + 1] += 1
+    site_ptr = np.cumsum(counts)
+    site_nbr = np.zeros(site_ptr[-1], dtype=np.int64)
+    site_shell = np.zeros(site_ptr[-1], dtype=np.int64)
+    fill = site_ptr[:-1].copy()
+    for i in range(num_distances):
+        for k in range(shell_ptr[i], shell_ptr[i + 1]):
+            j = shell_pairs[k]
+            a = center_indices[j]
+            b = point_indices[j]
+            if a != b:
+                site_nbr[fill[a]] = b
+                site_shell[fill[a]] = i
+                fill[a] += 1
+                site_nbr[fill[b]] = a
+                site_shell[fill[b]] = i
+                fill[b] += 1
+    return site_ptr, site_nbr, site_shell, np.diff(shell_ptr)
+
+
+def translation_permutations(structure, tol=1e-3):
+    """
+    Site permutations of the pure translations of a (magnetic) structure
+    inside its cell, identity excluded: perms[g, i] is the image of site i
+    under the g-th translation. For a supercell these include the
+    translations of the parent lattice, i.e. its quotient group Z^3/HZ^3.
+    """
+    frac = structure.frac_coords
+    species = np.array([site.species_string for site in structure])
+    perms = []
+    for k in range(1, len(structure)):
+        if species[k] != species[0]:
+            continue
+        dist = structure.lattice.get_all_distances(frac + (frac[k] - frac[0]), frac)
+        match = (dist < tol) & (species[:, None] == species[None, :])
+        if np.all(match.sum(axis=1) == 1):
+            perm = np.argmax(match, axis=1)
+            if len(np.unique(perm)) == len(structure):
+                perms.append(perm)
+    return np.array(perms, dtype=np.int64).reshape(-1, len(structure))
+
+
+def orbit_tests(perms, natom):
+    """
+    Group elements against which all_configs_orbits compares a
+    configuration: the translations perms (see translation_permutations),
+    the global spin flip and their products. inv[t, j] is the site whose
+    spin the t-th element moves to site j; flip[t] is 1 if it also
+    reverses all the spins.
+    """
+    inv = np.empty((len(perms), natom), dtype=np.int64)
+    for g, perm in enumerate(perms):
+        inv[g, perm] = np.arange(natom)
+    ntrans = len(perms)
+    inv = np.concatenate((inv, np.arange(natom)[None, :], inv))
+    flip = np.repeat(np.array([0, 1], dtype=np.int64), [ntrans, ntrans + 1])
+    return inv, flip
+
+
+@numba.njit
+def _row_hash(row):
+    h = np.uint64(14695981039346656037)
+    for v in row:
+        h = (h ^ np.uint64(v & 0xFFFFFFFF)) * np.uint64(1099511628211)
+    return h
+
+
+@numba.njit
+def _insert_row(rows, nrows, table, row):
+    # Append row to rows[:nrows] unless it is already there; table is an
+    # open-addressing hash table of indices into rows
+    mask = len(table) - 1
+    slot = np.int64(_row_hash(row) & np.uint64(mask))
+    while table[slot] >= 0:
+        if np.all(rows[table[slot]] == row):
+            return rows, nrows, table
+        slot = (slot + 1) & mask
+
+    if nrows == len(rows):
+        grown = np.empty((2 * len(rows), rows.shape[1]), dtype=rows.dtype)
+        grown[:nrows] = rows
+        rows = grown
+    rows[nrows] = row
+    table[slot] = nrows
+    nrows += 1
+
+    if 2 * nrows > len(table):
+        table = -np.ones(2 * len(table), dtype=np.int64)
+        mask = len(table) - 1
+        for r in range(nrows):
+            slot = np.int64(_row_hash(rows[r]) & np.uint64(mask))
+            while table[slot] >= 0:
+                slot = (slot + 1) & mask
+            table[slot] = r
+    return rows, nrows, table
+
+
+@numba.njit
+def all_configs_orbits(natom, site_ptr, site_nbr, site_shell, npairs, inv, flip):
+    """
+    Distinct rows of the A matrix over all the 2^natom configurations,
+    generated from one configuration per orbit of the global spin flip and
+    the translations (inv, flip, see orbit_tests), whose rows are equal.
+
+    The representative of an orbit is its smallest configuration as an
+    integer (bit i set for spin i down). The spins are set from the last
+    site down, depth first; after each one, every group element is
+    compared with the configuration on the bits already known, and the
+    branch is cut as soon as one element is known to give a smaller
+    configuration. So the work scales with the number of orbits, about
+    2^natom / (2 x number of translations), and not with 2^natom. The
+    interaction counts are updated with each spin set down (the pairs of
+    that site only), and the rows are deduplicated with a hash table as
+    they are produced.
+    """
+    num_distances = len(npairs)
+    ntest = inv.shape[0]
+    bits = np.zeros(natom, dtype=np.int64)
+    spins = np.ones(natom, dtype=np.int64)
+    interaction_counts = npairs.astype(np.int64)  # all spins up
+    row = np.ones(num_distances + 1, dtype=np.int32)
+
+    # pos[k, t]: next bit to compare for element t once the bits >= k are
+    # set, comparing from the last bit down (-1: t is decided)
+    pos = np.empty((natom + 1, ntest), dtype=np.int64)
+    pos[natom, :] = natom - 1
+    # stage[k]: number of values of bit k tried on the current branch
+    stage = np.zeros(natom, dtype=np.int64)
+
+    rows = np.empty((1024, num_distances + 1), dtype=np.int32)
+    nrows = 0
+    table = -np.ones(2048, dtype=np.int64)
+
+    k = natom - 1
+    while k < natom:
+        # The last spin of a representative is up
+        if stage[k] == 2 or (k == natom - 1 and stage[k] == 1):
+            if bits[k]:
+                for e in range(site_ptr[k], site_ptr[k + 1]):
+                    interaction_counts[site_shell[e]] -= 2 * spins[k] * spins[site_nbr[e]]
+                spins[k] = -spins[k]
+                bits[k] = 0
+            stage[k] = 0
+            k += 1
+            continue
+        if stage[k] == 1:
+            for e in range(site_ptr[k], site_ptr[k + 1]):
+                interaction_counts[site_shell[e]] -= 2 * spins[k] * spins[site_nbr[e]]
+            spins[k] = -spins[k]
+            bits[k] = 1
+        stage[k] += 1
+
+        smaller = False
+        for t in range(ntest):
+            p = pos[k + 1, t]
+            while p >= k:
+                src = inv[t, p]
+                if src < k:
+                    break
+                y = bits[src] ^ flip[t]
+                if y != bits[p]:
+                    smaller = y < bits[p]
+                    p = -1
+                    break
+                p -= 1
+            pos[k, t] = p
+            if smaller:
+                break
+        if smaller:
+            continue
+
+        if k > 0:
+            k -= 1
+            continue
+
+        for i in range(num_distances):
+            row[i + 1] = -interaction_counts[i]
+        rows, nrows, table = _insert_row(rows, nrows, table, row)
+
+    return rows[:nrows].copy()
+
+
+def shell_correlation_matrix(natom, unique_distances, center_indices, point_indices, distances):
+    """
+    Coefficients B of the columns of the A matrix in the basis
+    {1, s_i s_j (i < j)} of functions of the spins: with s_i^2 = 1, column s
+    of A is -(number of self-image pairs of shell s) - sum_{i<j} m_s(i, j)
+    s_i s_j, m_s(i, j) being the number of pairs {i, j} of the half neighbor
+    list in shell s (see shell_pair_matrices). These basis
+    functions are linearly independent, so the rank and the dependent
+    columns of A over all configurations are those of B. Only pairs present
+    in the neighbor list give a row; the first row is the constant term.
+    """
+    num_distances = len(unique_distances)
+    shell_ptr, shell_pairs = shell_csr(unique_distances, distances)
+    shell_of = np.repeat(np.arange(num_distances), np.diff(shell_ptr))
+    ci = center_indices[shell_pairs]
+    pj = point_indices[shell_pairs]
+
+    # Self-image pairs (i == j) only add to the constant term
+    self_image = ci == pj
+    const = np.zeros(num_distances + 1, dtype=np.int64)
+    const[0] = 1
+    const[1:] = -np.bincount(shell_of[self_image], minlength=num_distances)
+
+    off = ~self_image
+    key = np.minimum(ci[off], pj[off])*natom + np.maximum(ci[off], pj[off])
+    rows, inv = np.unique(key, return_inverse=True)
+    B = np.zeros((len(rows) + 1, num_distances + 1), dtype=np.int64)
+    B[0, :] = const
+    np.add.at(B, (inv + 1, shell_of[off] + 1), -1)
+
+    return B
+
+
+def unique_rows_chunked(evaluate, configurations, chunk_size):
+    """
+    Distinct rows of the A matrix of configurations, evaluated chunk_size
+    configurations at a time so that only one chunk of A is held at once.
+    """
+    new_A = np.unique(evaluate(configurations[:chunk_size]), axis=0)
+    for start in range(chunk_size, len(configurations), chunk_size):
+        rows = np.unique(evaluate(configurations[start:start + chunk_size]), axis=0)
+        new_A = np.unique(np.concatenate((new_A, rows)), axis=0)
+    return new_A
+
+
+def sample_configs_adaptive(rng, draw, evaluate, ncol, max_configs, batch_size, patience):
+    """
+    Draw random configurations in batches of batch_size and keep only the
+    new (unique) rows of A. The rank of the unique rows is followed with an
+    incremental echelon form (modulo a large prime) and the sampling stops
+    when it has not grown for `patience` consecutive batches, when A has
+    full column rank, or after max_configs configurations. draw(rng, n)
+    returns n random configurations and evaluate maps configurations to
+    rows of A (ncol columns).
+    Returns the unique rows of A and the number of configurations drawn.
+    """
+    p = large_primes(1)[0]
+    E = np.zeros((ncol, ncol), dtype=np.int64)
+    pivcol = np.zeros(ncol, dtype=np.int64)
+    rank = 0
+
+    seen = set()
+    rows = []
+    nconf_used = 0
+    stalled = 0
+    while nconf_used < max_configs and stalled < patience and rank < ncol:
+        nbatch = min(batch_size, max_configs - nconf_used)
+        confs = draw(rng, nbatch)
+        nconf_used += nbatch
+        A = evaluate(confs)
+
+        old_rank = rank
+        for row in A:
+            key = row.tobytes()
+            if key in seen:
+                continue
+            seen.add(key)
+            rows.append(row)
+            rank = echelon_insert_mod_p(E, pivcol, rank, row.astype(np.int64) % p, p)
+
+        stalled = stalled + 1 if rank == old_rank else 0
 
+    return np.array(rows), nconf_used
 
-structure = Structure.from_file(struc_file)
 
-latt = structure.lattice.matrix
+def half_neighbor_list(center_indices, point_indices, offset_vectors, distances):
+    """
+    Half of a neighbor list from get_neighbor_list, which holds every pair
+    twice, as (i, j, R) and (j, i, -R): keep i < j, and for the self-image
+    pairs (i, i, R) the image R whose first nonzero component is positive.
+    """
+    first = np.argmax(offset_vectors != 0, axis=1)
+    positive = offset_vectors[np.arange(len(first)), first] > 0
+    keep = (center_indices < point_indices) | ((center_indices == point_indices) & positive)
+    return center_indices[keep], point_indices[keep], offset_vectors[keep], distances[keep]
 
-if LatDim==2:
-    if not np.isclose(latt[0:2,-1],0).all() or not  np.isclose(latt[-1,0:2], 0).all():
-        raise ValueError("The lattice is not a 2D lattice (xx0, xx0,00x)")
-if LatDim==2:
-    if cutoff_radius > latt[-1,-1]:
-        raise ValueError(f"The lattice length in 00x ({latt[-1,-1]}) direction should be greater than cutoff radius ({cutoff_radius})")
 
-all_struct=generate_structures(structure, volumes, LatDim, write_str=True, verbosity=verbo)
+def self_image_shells(unique_distances, center_indices, point_indices, offset_vectors, distances, nshell):
+    """
+    Data of degenerate_supercells for the first nshell shells of a (half)
+    parent neighbor list: for every shell, None if it has a bond between
+    two different sites, else the images R of its bonds (i, i, R).
+    """
+    shell_ptr, shell_pairs = shell_csr(unique_distances, distances)
+    shell_images = []
+    for s in range(min(nshell, len(unique_distances))):
+        pairs = shell_pairs[shell_ptr[s]:shell_ptr[s + 1]]
+        if np.any(center_indices[pairs] != point_indices[pairs]):
+            shell_images.append(None)
+        else:
+            shell_images.append(np.rint(offset_vectors[pairs]).astype(np.int64))
+    return unique_distances[:len(shell_images)], shell_images
+
+
+def parent_site_translations(parent_structure, structure, tol=1e-3):
+    """
+    Write every site of a supercell of parent_structure as a parent site
+    plus a lattice translation: the Cartesian position of site i is that
+    of parent site site_parent[i] plus site_shift[i] (integer, in the basis
+    of the parent lattice).
+    """
+    parent_frac = parent_structure.frac_coords
+    frac = parent_structure.lattice.get_fractional_coords(structure.cart_coords)
+    diff = frac[:, None, :] - parent_frac[None, :, :]
+    shift = np.rint(diff)
+    error = np.linalg.norm(parent_structure.lattice.get_cartesian_coords(diff - shift), axis=2)
+    parent_species = np.array([site.species_string for site in parent_structure])
+    species = np.array([site.species_string for site in structure])
+    match = (error < tol) & (species[:, None] == parent_species[None, :])
+    if not np.all(match.sum(axis=1) == 1):
+        raise ValueError("The supercell sites do not map onto the parent structure")
+    site_parent = np.argmax(match, axis=1)
+    site_shift = shift[np.arange(len(structure)), site_parent].astype(np.int64)
+    return site_parent, site_shift
+
+
+@numba.njit(cache=True)
+def _translation_key(H, parent_site, shift):
+    # Reducing the translation modulo the columns of H gives 0 <= t < diag(H)
+    t0, t1, t2 = shift[0], shift[1], shift[2]
+    q = t0 // H[0, 0]
+    t0 -= q * H[0, 0]
+    t1 -= q * H[1, 0]
+    t2 -= q * H[2, 0]
+    q = t1 // H[1, 1]
+    t1 -= q * H[1, 1]
+    t2 -= q * H[2, 1]
+    t2 -= (t2 // H[2, 2]) * H[2, 2]
+    return ((parent_site * H[0, 0] + t0) * H[1, 1] + t1) * H[2, 2] + t2
 
 
-ABC_min=[]
-for vol in all_struct:
-    for i in range(len(all_struct[vol])):
-        ABC_min.append(min(all_struct[vol][i].lattice.abc))
+@numba.njit(cache=True)
+def _map_parent_pairs(H, site_parent, site_shift, site_of_key, center_ptr, pair_order, point, offsets):
+    nsite = len(site_parent)
+    npair = 0
+    for i in range(nsite):
+        npair += center_ptr[site_parent[i] + 1] - center_ptr[site_parent[i]]
+    sc_center = np.empty(npair, dtype=np.int64)
+    sc_point = np.empty(npair, dtype=np.int64)
+    pair = np.empty(npair, dtype=np.int64)
+    shift = np.empty(3, dtype=np.int64)
+    n = 0
+    for i in range(nsite):
+        for k in range(center_ptr[site_parent[i]], center_ptr[site_parent[i] + 1]):
+            p = pair_order[k]
+            for x in range(3):
+                shift[x] = site_shift[i, x] + offsets[p, x]
+            sc_center[n] = i
+            sc_point[n] = site_of_key[_translation_key(H, point[p], shift)]
+            pair[n] = p
+            n += 1
+    return sc_center, sc_point, pair
 
 
-if max(ABC_min) > cutoff_radius:
-        raise ValueError(f"Increase cutoff_radius to { max(ABC_min) +0.25*max(ABC_min)} or greater")
+def supercell_hnf(parent_lattice, structure):
+    """
+    HNF (same convention as get_all_HNFs) of the lattice of a supercell:
+    its columns span the supercell lattice in the basis of the parent.
+    """
+    T = np.rint(structure.lattice.matrix @ np.linalg.inv(parent_lattice)).astype(np.int64)
+    return hermite_normal_form(np.ascontiguousarray(T.T))
 
 
-for element in structure.composition.elements:
-     if element.name in magnetic_atoms:
-        element.is_magnetic = True
-     else:
-        element.is_magnetic = False
+def supercell_neighbor_list(parent_structure, parent_neighbors, structure):
+    """
+    Neighbor list of a supercell derived from the one of its parent with
+    integer arithmetic only, instead of structure.get_neighbor_list.
 
-non_magnetic_atoms = [element.symbol for element in structure.composition.elements if not element.is_magnetic]
+    Every pair (parent site a, parent site b, image R, distance d) of the
+    parent gives, for each supercell site i above a (at translation t_i),
+    the pair (i, j, d), where j is the supercell site above b at the
+    translation t_i + R modulo the supercell lattice. The distances are
+    those of the parent list, so the pairs and shells are the same as with
+    structure.get_neighbor_list at the same cutoff radius. A half parent
+    list (see half_neighbor_list) gives a half supercell list: each pair
+    and image once, though not always with i <= j.
 
+    parent_neighbors is (center_indices, point_indices, offset_vectors,
+    distances) of the parent. Returns (center_indices, point_indices,
+    distances) of the supercell.
+    """
+    center, point, offsets, distances = parent_neighbors
+    offsets = np.rint(offsets).astype(np.int64)
 
-structure.remove_species(non_magnetic_atoms)
+    # Supercell lattice in the parent basis, spanned by the columns of its
+    # HNF H (lower triangular)
+    H = supercell_hnf(parent_structure.lattice.matrix, structure)
 
+    site_parent, site_shift = parent_site_translations(parent_structure, structure)
+    site_of_key = np.full(len(parent_structure) * H[0, 0] * H[1, 1] * H[2, 2], -1, dtype=np.int64)
+    for i in range(len(structure)):
+        site_of_key[_translation_key(H, site_parent[i], site_shift[i])] = i
 
-center_indices, point_indices, offset_vectors, distances = structure.get_neighbor_list(cutoff_radius)
-unique_distances, counts = np.unique(np.around(distances, 3), return_counts=True)
-print("distances=", unique_distances[:40])
+    # Parent pairs grouped by center site
+    pair_order = np.argsort(center, kind='stable')
+    center_ptr = np.concatenate(([0], np.cumsum(np.bincount(center, minlength=len(parent_structure)))))
 
-unique_distances1, counts1 = np.unique(np.around(distances, 2), return_counts=True)
-print("distances=", unique_distances1[:10])
+    sc_center, sc_point, pair = _map_parent_pairs(H, site_parent, site_shift, site_of_key, center_ptr, pair_order, point, offsets)
 
+    return sc_center, sc_point, distances[pair]
 
-def analysis_structures(vol, seed):
+
+def analysis_structure(vol, n, structure, seed, magnetic_atoms, cutoff_radius, nconf, all_configs, adaptive_configs=False, config_batch=10, saturation_batches=3, system_engine='auto', rank_method='configurations', parent=None, max_memory_per_worker=1024):
+    """
+    Analyze one supercell (number n of volume vol). This is the unit of work
+    of the process pool; seed is the SeedSequence of this supercell only.
+    structure is the supercell as a Structure, or as a Supercell, which is
+    then built here from the (magnetic) parent structure.
+    parent is (parent structure, its half neighbor list), both restricted
+    to the magnetic atoms, from which the neighbor list of the supercell is
+    derived; without it the neighbor list is computed from the supercell.
+    All the kernels take half neighbor lists (every pair and image once).
+    """
     rng = np.random.default_rng(seed)  # Initialize RNG with the provided seed
     # Create a list to capture the output
 
-    struct_info={'struct_vol':[], 'struct_num':[], 'first_dep_col_ind':[], 'permitted_farthest_J':[], 'rank':[], 'independent_configs':[], 'latt_abc_var':[]}
+    struct_info={}
 
     output = []
-     
-    output.append("----------------------")
-    output.append(str(vol))
 
-    nstruct = len(all_struct[vol])
+    if isinstance(structure, Supercell):
+        structure = structure.structure(parent[0])
 
-    for n in range(nstruct):
-        structure = all_struct[vol][n]
+    for element in structure.composition.elements:
+        if element.name in magnetic_atoms:
+            element.is_magnetic = True
+        else:
+            element.is_magnetic = False
 
+    non_magnetic_atoms = [element.symbol for element in structure.composition.elements if not element.is_magnetic]
 
-        for element in structure.composition.elements:
-            if element.name in magnetic_atoms:
-                element.is_magnetic = True
-            else:
-                element.is_magnetic = False
+    structure.remove_species(non_magnetic_atoms)
 
-        non_magnetic_atoms = [element.symbol for element in structure.composition.elements if not element.is_magnetic]
+    natom = structure.num_sites
 
-        structure.remove_species(non_magnetic_atoms)
+    if parent is None:
+        center_indices, point_indices, offset_vectors, distances = half_neighbor_list(*structure.get_neighbor_list(cutoff_radius))
+    else:
+        center_indices, point_indices, distances = supercell_neighbor_list(*parent, structure)
+    unique_distances, counts = np.unique(np.around(distances, 3), return_counts=True)
 
-        natom = structure.num_sites
+    if rank_method == 'exact':
+        # No configurations: rank profile of the coefficients of A in the
+        # basis {1, s_i s_j}, i.e. the limit of an infinite number of samples
+        new_A = np.unique(shell_correlation_matrix(natom, unique_distances, center_indices, point_indices, distances), axis=0)
+        N1 = 0
+    elif all_configs:
+        # One configuration per orbit of the spin flip and translations,
+        # only the distinct rows are stored
+        site_ptr, site_nbr, site_shell, npairs = site_shell_neighbors(natom, unique_distances, center_indices, point_indices, distances)
+        inv, flip = orbit_tests(translation_permutations(structure), natom)
+        new_A = all_configs_orbits(natom, site_ptr, site_nbr, site_shell, npairs, inv, flip)
+        N1 = 2**natom
+    else:
+        num_distances = len(unique_distances)
+        # Dense shell matrices (BLAS) unless they would take more than 256 MB
+        if system_engine == 'auto':
+            system_engine = 'blas' if num_distances*natom*natom*4 <= 2**28 else 'bits'
+        # Bytes per configuration: its row of A (int32) and spins, plus the
+        # engine temporaries; fixed bytes: the shell data of the engine
+        bytes_per_config = 4*(num_distances + 1)
+        if system_engine == 'bits':
+            # Configurations packed 64 spins per word
+            masks, nlayer, npairs = shell_pair_masks(natom, unique_distances, center_indices, point_indices, distances)
+            evaluate = lambda confs: system_bits(confs, masks, nlayer, npairs)
+            draw = lambda rng, n: random_packed_configs(rng, n, natom)
+            bytes_per_config += 8*((natom + 63)//64)
+            fixed_bytes = masks.nbytes
+        else:
+            if system_engine == 'blas':
+                M = shell_pair_matrices(natom, unique_distances, center_indices, point_indices, distances)
+                evaluate = lambda confs: system_blas(confs, M)
+                block = min(num_distances, blas_shell_block(natom))
+                bytes_per_config += 8*(natom + block*natom + 2*block)
+                fixed_bytes = M.nbytes + 8*block*natom*natom
+            else:
+                evaluate = lambda confs: system(confs, unique_distances, center_indices, point_indices, distances)
+                fixed_bytes = 0
+            draw = lambda rng, n: rng.choice([-1, 1], (n, natom)).astype(np.int8)
+            bytes_per_config += natom
 
-        if all_configs:
-            confs = np.array(list(product([-1, 1], repeat=natom)))
+        if not adaptive_configs:
+            chunk_size = max(1, (max_memory_per_worker*2**20 - fixed_bytes) // bytes_per_config)
+            new_A = unique_rows_chunked(evaluate, draw(rng, nconf), chunk_size)
+            N1 = nconf
         else:
-            confs = rng.choice([-1, 1], (nconf, natom))
-
-        center_indices, point_indices, offset_vectors, distances = structure.get_neighbor_list(cutoff_radius)
-        unique_distances, counts = np.unique(np.around(distances, 3), return_counts=True)
-        A = system(confs, unique_distances, center_indices, point_indices, distances)
-
-        new_A = np.unique(A, axis=0)
-        
-        matrix_rank=np.linalg.matrix_rank(new_A)
-        
-        struct_info['struct_vol'].append(vol)
-        struct_info['struct_num'].append(n)
-        struct_info['rank'].append(matrix_rank)
-        N1,_=A.shape
-        N2,_=new_A.shape
-        struct_info['independent_configs'].append(np.round(N2/N1*100, 1))
-      
-        output.append("--------------------------")
-        output.append(f"struct_vol={vol}, struct_num={n}, rank={matrix_rank}")
-        output.append(f"Structure details:")
-        output.append(f"a        b        c        alpha      beta      gamma")
-        output.append(f"{structure.lattice.a:6.4f}  {structure.lattice.b:6.4f}  {structure.lattice.c:6.4f} {structure.lattice.alpha:10.4f} {structure.lattice.beta:10.4f}  {structure.lattice.gamma:10.4f}")
-        output.append(f"variance of lattice parameters (a,b,c): {np.array(structure.lattice.abc).var()}")
-        output.append(f"\n")
-        
-        struct_info['latt_abc_var'].append(np.array(structure.lattice.abc).var())
-
-        output.append("Shape of matrix")
-        output.append(f"shape A {A.shape}, shape new A {new_A.shape}")
-
-        output.append("==First column depen===")
-
-        Mat = sy.Matrix(new_A)
-        # The idea is to use DomainMatrix lib insead of using directly Mat.nullspace() to spead up the program!
-        # https://stackoverflow.com/questions/76219046/numeric-calculation-of-nullspace-with-sympy-is-slow
-
-        DM=DomainMatrix.from_Matrix(Mat)
-        Null=DM.to_field().nullspace().to_Matrix()
-
-        Numarr=np.array(Null[0,:]).flatten()
-
-        output.append("first_dep_col_ind")
-        last_col = np.where(Numarr == 1)[0][-1]
-        output.append(str(last_col))
-        
-        struct_info['first_dep_col_ind'].append(last_col)
-        last_J=f"J{last_col-1}"
-        struct_info['permitted_farthest_J'].append(last_J)
-
-        output.append("***********************")
-        output.append("")
+            # Stop drawing configurations once the rank of A is saturated
+            new_A, N1 = sample_configs_adaptive(rng, draw, evaluate, len(unique_distances) + 1, nconf, config_batch, saturation_batches)
+    
+    # Exact rank and first dependent column from a single (multi-prime) row reduction
+    matrix_rank, pivots, last_col = rank_profile(new_A)
+    
+    struct_info['struct_vol'] = vol
+    struct_info['struct_num'] = n
+    N2,_=new_A.shape
+
+    output.append("--------------------------")
+    output.append(f"struct_vol={vol}, struct_num={n}, rank={matrix_rank}")
+    output.append(f"Structure details:")
+    output.append(f"a        b        c        alpha      beta      gamma")
+    output.append(f"{structure.lattice.a:6.4f}  {structure.lattice.b:6.4f}  {structure.lattice.c:6.4f} {structure.lattice.alpha:10.4f} {structure.lattice.beta:10.4f}  {structure.lattice.gamma:10.4f}")
+    output.append(f"variance of lattice parameters (a,b,c): {np.array(structure.lattice.abc).var()}")
+    output.append(f"\n")
+    
+
+    output.append("Shape of matrix")
+    output.append(f"shape A {(N1, new_A.shape[1])}, shape new A {new_A.shape}")
+
+    output.append("==First column depen===")
+
+    output.append("first_dep_col_ind")
+    output.append(str(last_col))
+    
+    struct_info['first_dep_col_ind'] = last_col
+    last_J=f"J{last_col-1}"
+    struct_info['permitted_farthest_J'] = last_J
+    struct_info['rank'] = matrix_rank
+    struct_info['independent_configs'] = np.round(N2/N1*100, 1) if N1 else np.nan
+    struct_info['n_configs_used'] = N1
+    struct_info['latt_abc_var'] = np.array(structure.lattice.abc).var()
+
+    output.append("***********************")
+    output.append("")
 
     # Return the captured output
     return output, struct_info
 
-def main():
-    # Create a SeedSequence object
-    ss = np.random.SeedSequence(seed)
-    seeds = ss.spawn(len(volumes))
-    # Assuming all required data and variables are already defined
-    struct_info_all={'struct_vol':[], 'struct_num':[], 'first_dep_col_ind':[], 'permitted_farthest_J':[], 'rank':[], 'independent_configs':[], 'latt_abc_var':[]}
-    #num_processes = 4  # Adjust the number of processes as needed
-
-    with Pool(processes=num_processes) as pool:
-        args = [(volumes[i], seeds[i]) for i in range(len(volumes))]
-        results = list(tqdm(pool.starmap(analysis_structures, args), total=len(volumes)))
-    
-    # Print the results sequentially
-    for result_print, struct_info  in results:
-        for line in result_print:
-            print(line)
-        for i in range(len(struct_info['struct_vol'])):
-            struct_info_all['struct_vol'].append(struct_info['struct_vol'][i])
-            struct_info_all['struct_num'].append(struct_info['struct_num'][i])
-            struct_info_all['first_dep_col_ind'].append(struct_info['first_dep_col_ind'][i])
-            struct_info_all['permitted_farthest_J'].append(struct_info['permitted_farthest_J'][i])
-            struct_info_all['rank'].append(struct_info['rank'][i])
-            struct_info_all['independent_configs'].append(struct_info['independent_configs'][i])
-            struct_info_all['latt_abc_var'].append(struct_info['latt_abc_var'][i])
+# Set in every pool worker by _init_worker: the parent and the settings
+# shared by all the tasks
+_worker = {}
+
+def _init_worker(parent_handle, settings):
+    _worker['parent'] = attach_parent(parent_handle)
+    _worker['settings'] = settings
+
+def _analysis_task(args):
+    vol, n, supercell, seed = args
+    return analysis_structure(vol, n, supercell, seed, parent=_worker['parent'], **_worker['settings'])
+
+def load_structure(config):
+    structure = Structure.from_file(config.structure_file)
+
+    latt = structure.lattice.matrix
+
+    if config.LatDim==2:
+        if not np.isclose(latt[0:2,-1],0).all() or not  np.isclose(latt[-1,0:2], 0).all():
+            raise ValueError("The lattice is not a 2D lattice (xx0, xx0,00x)")
+    if config.LatDim==2:
+        if config.cutoff_radius > latt[-1,-1]:
+            raise ValueError(f"The lattice length in 00x ({latt[-1,-1]}) direction should be greater than cutoff radius ({config.cutoff_radius})")
+
+    return structure
+
+
+def estimate(config):
+    """Dry run: predicted workload per volume, see estimate_workload."""
+    config = get_variables(config)
+    structure = load_structure(config)
+    return pd.DataFrame(estimate_workload(structure, config.volumes, config.LatDim, config.magnetic_atoms, config.cutoff_radius))
+
+
+def analysis_dataframe(struct_infos):
+    """struct_analysis.csv table, from the best to the worst supercell."""
+    struct_info_all={'struct_vol':[], 'struct_num':[], 'first_dep_col_ind':[], 'permitted_farthest_J':[], 'rank':[], 'independent_configs':[], 'latt_abc_var':[], 'n_configs_used':[]}
+    for struct_info in struct_infos:
+        for key in struct_info_all:
+            struct_info_all[key].append(struct_info[key])
 
     struct_info_all_df=pd.DataFrame(struct_info_all)
     df = struct_info_all_df.sort_values(['first_dep_col_ind', 'struct_vol', 'independent_configs', 'latt_abc_var'] , ascending=[False, True, False, True])
-    df.to_csv('struct_analysis.csv', index=False)
+    return df
+
+
+def rebuild(config):
+    """The analysis table of all the supercells in the journal of config."""
+    config = get_variables(config)
+    structure = load_structure(config)
+    records = load_journal(config.journal, settings_key(config, structure))
+    records = sorted(records.values(), key=lambda r: (r['vol'], r['struct_info']['struct_num']))
+    return analysis_dataframe([record['struct_info'] for record in records])
+
+
+def run(config, csv_file=None):
+    """
+    Generate the supercells described by config (the content of input.txt,
+    as a dict or a namespace), analyze them on a process pool and return
+    the analysis as a DataFrame sorted from the best to the worst supercell.
+    With target_J = n, the volumes are analyzed in increasing order and the
+    run stops at the smallest volume with a supercell resolving J1..Jn; the
+    volumes are generated as the search reaches them, and the DataFrame
+    only holds the supercells analyzed so far.
+    In target_J mode, or unless write_supercells is "all" and write_filter
+    is unset, no POSCAR
+    file is written during the generation: once the supercells are ranked,
+    only the best write_supercells of those matching write_filter are.
+    If csv_file is given, the DataFrame is written to it (before these
+    POSCAR files).
+    Every analysis is appended to the journal as soon as it is done, and
+    the supercells already in the journal are not analyzed again.
+    """
+    config = get_variables(config)
+    volumes = config.volumes
+    magnetic_atoms = config.magnetic_atoms
+    cutoff_radius = config.cutoff_radius
+
+    structure = load_structure(config)
+
+    # Analyses of a previous (interrupted or smaller) run with the same settings
+    journal_key = settings_key(config, structure) if config.journal else None
+    done = load_journal(config.journal, journal_key)
+
+    for element in structure.composition.elements:
+         if element.name in magnetic_atoms:
+            element.is_magnetic = True
+         else:
+            element.is_magnetic = False
+
+    non_magnetic_atoms = [element.symbol for element in structure.composition.elements if not element.is_magnetic]
+
+
+    magnetic_structure = structure.copy()
+    magnetic_structure.remove_species(non_magnetic_atoms)
+
+
+    center_indices, point_indices, offset_vectors, distances = half_neighbor_list(*magnetic_structure.get_neighbor_list(cutoff_radius))
+    unique_distances, counts = np.unique(np.around(distances, 3), return_counts=True)
+    print("distances=", unique_distances[:40])
+
+    unique_distances1, counts1 = np.unique(np.around(distances, 2), return_counts=True)
+    print("distances=", unique_distances1[:10])
+
+    # Supercells in which one of the first shells only couples a site to its
+    # own images cannot resolve them: they are not built
+    prefilter_shells = config.target_J if config.prefilter_shells is None else config.prefilter_shells
+    prune_shells = None
+    if prefilter_shells is not None:
+        prune_shells = self_image_shells(unique_distances, center_indices, point_indices, offset_vectors, distances, prefilter_shells)
+
+    # POSCAR files written now, or only for the best supercells after the
+    # ranking; in target_J mode only the analyzed supercells can be written
+    lazy_write = config.target_J is not None or config.write_supercells != "all" or config.write_filter is not None
+    # In target_J mode each volume is only generated when the search reaches it
+    batches = [[vol] for vol in sorted(volumes)] if config.target_J is not None else [volumes]
+
+    # The neighbor lists of the supercells are derived from this one
+    parent = (magnetic_structure, (center_indices, point_indices, offset_vectors, distances))
+    settings = dict(magnetic_atoms=magnetic_atoms, cutoff_radius=cutoff_radius, nconf=config.n_configs, all_configs=config.all_configs, adaptive_configs=config.adaptive_configs, config_batch=config.config_batch, saturation_batches=config.saturation_batches, system_engine=config.system_engine, rank_method=config.rank_method, max_memory_per_worker=config.max_memory_per_worker)
+
+    all_struct = {}
+    hnfs = {}
+    results = {}
+    remaining = {}
+    target_vol = None
+
+    def collect(result_print, struct_info):
+        # Store one result; True when the target_J search is over
+        nonlocal target_vol
+        vol = struct_info['struct_vol']
+        results[(vol, struct_info['struct_num'])] = (result_print, struct_info)
+        remaining[vol] -= 1
+        if config.target_J is None:
+            return False
+        # J1..Jn are resolved when the first dependent column is after Jn
+        if struct_info['first_dep_col_ind'] > config.target_J and (target_vol is None or vol < target_vol):
+            target_vol = vol
+        # Smaller volumes still running could resolve the target too
+        return target_vol is not None and all(remaining[v] == 0 for v in remaining if v < target_vol)
+
+    if done and os.path.exists('log.txt'):
+        # Resumed run: log.txt is written again for all the volumes
+        os.remove('log.txt')
+
+    journal = None
+    stop = False
+    # The parent and its neighbor list are mapped by the workers, not sent with every task
+    with tempfile.TemporaryDirectory() as shared_dir:
+        parent_handle = publish_parent(shared_dir, *parent)
+        with Pool(processes=config.num_processes, initializer=_init_worker, initargs=(parent_handle, settings)) as pool:
+            for batch in batches:
+                # The supercells directory is reused on resume and by the later batches
+                batch_struct = generate_structures(structure, batch, config.LatDim, write_str=not lazy_write, verbosity=config.verbosity, dedupe_method=config.dedupe_method, use_cache=config.use_cache, cache_dir=config.cache_dir, num_processes=config.num_processes, prune_shells=prune_shells, exist_ok=bool(done) or bool(all_struct))
+                all_struct.update(batch_struct)
+                if journal is None and config.journal:
+                    journal = open_journal(config.journal)
+
+                ABC_min = [min(np.linalg.norm(supercell.lattice(structure.lattice.matrix), axis=1)) for vol in batch for supercell in batch_struct[vol].values()]
+                if ABC_min and max(ABC_min) > cutoff_radius:
+                    raise ValueError(f"Increase cutoff_radius to { max(ABC_min) +0.25*max(ABC_min)} or greater")
+
+                for vol in batch:
+                    remaining[vol] = len(all_struct[vol])
+                    for n, supercell in all_struct[vol].items():
+                        hnfs[(vol, n)] = tuple(supercell.hnf.ravel().tolist())
+                        if (vol, hnfs[(vol, n)]) in done:
+                            stop = collect(done[(vol, hnfs[(vol, n)])]['output'], done[(vol, hnfs[(vol, n)])]['struct_info'])
+
+                # One task per supercell, the most expensive (largest) ones first so that
+                # no worker is left with a big supercell at the end of the run. Each task
+                # has its own SeedSequence child, labelled by (volume, supercell number),
+                # so the results do not depend on num_processes or on the task order.
+                tasks = [(vol, n) for vol in batch for n in all_struct[vol] if (vol, n) not in results]
+                tasks.sort(key=lambda t: (-t[0], t[1]))
+                args = [(vol, n, all_struct[vol][n], np.random.SeedSequence(config.seed, spawn_key=(vol, n))) for vol, n in tasks]
+
+                if args and not stop:
+                    for result_print, struct_info in tqdm(pool.imap_unordered(_analysis_task, args), total=len(args)):
+                        vol, n = struct_info['struct_vol'], struct_info['struct_num']
+                        if journal is not None:
+                            append_record(journal, journal_key, vol, hnfs[(vol, n)], struct_info, result_print)
+                        if collect(result_print, struct_info):
+                            stop = True
+                            break
+                if stop:
+                    break
+            # Leaving the pool terminates the tasks still running or queued
+    if journal is not None:
+        journal.close()
+    if done:
+        print(f"{sum((vol, hnf) in done for (vol, n), hnf in hnfs.items())} supercells read from the journal {config.journal}")
+
+    if not any(all_struct.values()):
+        print(f"Every supercell was pruned: none can resolve J1..J{prefilter_shells} up to volume {max(volumes)}")
+        df = analysis_dataframe([])
+        if csv_file is not None:
+            df.to_csv(csv_file, index=False)
+        return df
+
+    # Print the results sequentially
+    struct_infos = []
+    for vol in volumes:
+        analyzed = [n for n in sorted(all_struct.get(vol, {})) if (vol, n) in results]
+        if not analyzed:
+            continue
+        print("----------------------")
+        print(str(vol))
+        for n in analyzed:
+            result_print, struct_info = results[(vol, n)]
+            for line in result_print:
+                print(line)
+            struct_infos.append(struct_info)
+
+    if config.target_J is not None:
+        nsupercell = sum(len(all_struct[vol]) for vol in all_struct)
+        if target_vol is None:
+            print(f"No supercell resolves J1..J{config.target_J} up to volume {max(volumes)}")
+        else:
+            print(f"J1..J{config.target_J} resolved at volume {target_vol}; {nsupercell - len(results)} of the {nsupercell} supercells generated not analyzed")
+            skipped = [vol for vol in volumes if vol not in all_struct]
+            if skipped:
+                print(f"Volumes {skipped[0]} to {skipped[-1]} not generated")
+
+    df = analysis_dataframe(struct_infos)
+    if csv_file is not None:
+        df.to_csv(csv_file, index=False)
+
+    if lazy_write:
+        selected = df.query(config.write_filter) if config.write_filter is not None else df
+        if config.write_supercells != "all":
+            selected = selected.head(config.write_supercells)
+        write_supercells([all_struct[vol][n] for vol, n in zip(selected['struct_vol'], selected['struct_num'])], structure)
+        print(f"{len(selected)} of {len(df)} supercells written to supercells/")
+
+    return df
+
+def main():
+    args = parse_command_line()
+    config = read_input(args.input_file)
+
+    if args.estimate:
+        df = estimate(config)
+        print(df.to_string(index=False))
+        print(f"Total number of supercells: {df['n_supercells'].sum()}")
+        print(f"Total number of magnetic sites: {df['total_magnetic_sites'].sum()}")
+        return
+
+    if args.rebuild:
+        df = rebuild(config)
+        df.to_csv('struct_analysis.csv', index=False)
+    else:
+        df = run(config, 'struct_analysis.csv')
     print(df.head(20))
 
 if __name__ == "__main__":
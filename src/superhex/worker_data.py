@@ -0,0 +1,56 @@
+######################################################################
+# This routine is part of
+# SUPERHEX - Supercell Optimization for Heisenberg Exchange Calculations 
+# (c) 2024-2025  Dr. Mojtaba Alaei and  Dr. Nafise Rezaei
+# Physics Department, Isfahan University of Technology, Isfahan, Iran
+#
+# This program is free software: you can redistribute it and/or modify it 
+# under the terms of the GNU General Public License as published by the 
+# Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY 
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License 
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along 
+# with this program. If not, see http://www.gnu.org/licenses. 
+#######################################################################
+
+
+# Read-only data shared by the worker processes of the analysis pool.
+#
+# The parent structure (restricted to the magnetic atoms) and its half
+# neighbor list are saved once as .npy files; every worker maps them
+# read-only when it starts, so that they are neither pickled with every
+# task nor copied in the memory of every worker.
+
+import os
+
+import numpy as np
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.structure import Structure
+
+PARENT_ARRAYS = ("lattice", "frac_coords", "center_indices", "point_indices", "offset_vectors", "distances")
+
+
+def publish_parent(directory, structure, neighbors):
+    """
+    Save the parent structure and its neighbor list (center_indices,
+    point_indices, offset_vectors, distances) in directory. Returns the
+    handle to pass to attach_parent.
+    """
+    arrays = (structure.lattice.matrix, structure.frac_coords) + tuple(neighbors)
+    for name, array in zip(PARENT_ARRAYS, arrays):
+        np.save(os.path.join(directory, name + ".npy"), np.ascontiguousarray(array))
+    return directory, [site.species_string for site in structure]
+
+
+def attach_parent(handle):
+    """The parent structure and its neighbor list, mapped from the files of publish_parent."""
+    directory, species = handle
+    # np.asarray drops the memmap subclass, the data stays mapped (read-only)
+    arrays = {name: np.asarray(np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")) for name in PARENT_ARRAYS}
+    structure = Structure(Lattice(arrays["lattice"]), species, arrays["frac_coords"])
+    return structure, tuple(arrays[name] for name in PARENT_ARRAYS[2:])
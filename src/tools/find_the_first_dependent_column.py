@@ -11,6 +11,8 @@ import scipy.linalg as la
 
 from pymatgen.core.structure import Structure
 
+from superhex.rank_lib import rank_profile
+
 import argparse
 
 # Create the parser
@@ -105,25 +107,21 @@ A = system(conf)
 
 new_A, index  = np. unique(A, return_index=True, axis=0)
 
-print("rank of matrix A:", np.linalg.matrix_rank(new_A))
+matrix_rank, pivots, last_col = rank_profile(new_A)
+print("rank of matrix A:", matrix_rank)
 print("shape A", A.shape, "shape new A", new_A.shape)
-Mat=sy.Matrix(new_A)
-DM=DomainMatrix.from_Matrix(Mat)
-print("Nullspcae information")
-
-
-
-Null_vec=DM.to_field().nullspace().to_Matrix()
-Numarr=np.array(Null_vec[0,:]).flatten()
-last_col = np.where(Numarr == 1)[0][-1]
 
 print("First dependent column index", last_col)
 print(f"We are allows to compute exchanges up to J{last_col-1}")
-n,m=Null_vec.shape
 
 if verbosity=='high':
+    Mat=sy.Matrix(new_A)
+    DM=DomainMatrix.from_Matrix(Mat)
+    print("Nullspcae information")
+    Null_vec=DM.to_field().nullspace().to_Matrix()
+    n,m=Null_vec.shape
     for i in range(n):
-          print(DM.to_field().nullspace().to_Matrix()[i,:])
+          print(Null_vec[i,:])
 
 
 
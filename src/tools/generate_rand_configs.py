@@ -27,6 +27,8 @@ import scipy.linalg as la
 
 from pymatgen.core.structure import Structure
 
+from superhex.rank_lib import rank_profile
+
 import argparse
 
 # Create the parser
@@ -137,21 +139,19 @@ l,q=new_A.shape
 
 
 if verbosity=='high':
-    print("rank of matrix A:", np.linalg.matrix_rank(new_A))
+    matrix_rank, pivots, last_col = rank_profile(new_A)
+    print("rank of matrix A:", matrix_rank)
+
+    print("First dependent column index", last_col)
+    print(f"We are allows to compute exchanges up to J{last_col-1}")
+
     Mat=sy.Matrix(new_A)
     DM=DomainMatrix.from_Matrix(Mat)
     print("Nullspcae information")
-    
     Null_vec=DM.to_field().nullspace().to_Matrix()
-    Numarr=np.array(Null_vec[0,:]).flatten()
-    last_col = np.where(Numarr == 1)[0][-1]
-
-    print("First dependent column index", last_col)
-    print(f"We are allows to compute exchanges up to J{last_col-1}")
     n,m=Null_vec.shape
-
     for i in range(n):
-          print(DM.to_field().nullspace().to_Matrix()[i,:])
+          print(Null_vec[i,:])
 
 if l>= num_confis:
     np.savetxt(configs_file, conf[index[:num_confis]], fmt='%2d')